@@ -1,19 +1,31 @@
 import os
+import sys
 import time
-import csv
 import logging
 import smtplib
 import numpy as np
+import struct
 import json
-from datetime import datetime
 from liquidctl import find_liquidctl_devices
 import subprocess
 import argparse
-import glob
+import queue
+import threading
+from collections import deque
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the kernel then runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 LOG_FILE = '/var/log/fan_monitor_qlearning.log'
-DATA_FILE = '/var/log/fan_monitor_data.csv'
-Q_TABLE_FILE = '/var/log/q_table.json'
+DATA_FILE = '/var/log/fan_monitor_data.bin'  # Fixed-size binary records, see DATA_REC
+Q_TABLE_FILE = '/var/log/q_table.npy'  # Periodic full snapshot
+Q_TABLE_LOG = '/var/log/q_table.log'  # Append-only deltas since last snapshot
+LEGACY_Q_TABLE_FILE = '/var/log/q_table.json'  # {"s0_s1": {"rad_chs": q}} table from older versions
+Q_COMPACT_INTERVAL = 1000  # Iterations between snapshot compactions
+DATA_FLUSH_INTERVAL = 30  # Iterations between data file flushes (5 minutes)
 
 # Q-learning parameters
 alpha = 0.1  # Learning rate (increased for faster learning)
@@ -36,6 +48,27 @@ fan_step = 10  # Step size for fan adjustments
 # Noise penalty (reduced to allow more aggressive cooling when needed)
 noise_penalty = 0.2
 
+# liquidctl status keys of the radiator sensors (exact match)
+_TEMP_KEYS = {'Temperature 0': 'out', 'Temperature 1': 'in'}
+
+# Action grid: actions are (ri, ci) indices into these speed arrays
+rad_speeds = np.arange(rad_min, rad_max + 1, fan_step)
+chs_speeds = np.arange(chs_min, chs_max + 1, fan_step)
+N_ACTIONS = len(rad_speeds) * len(chs_speeds)
+# Built once: plain-int speed lookups and q_step parameters
+_RAD_SPEED_VALUES = tuple(int(v) for v in rad_speeds)
+_CHS_SPEED_VALUES = tuple(int(v) for v in chs_speeds)
+_RAD_SPEED_IDX = {v: i for i, v in enumerate(_RAD_SPEED_VALUES)}
+_CHS_SPEED_IDX = {v: i for i, v in enumerate(_CHS_SPEED_VALUES)}
+_TARGETS = np.array([temp_target, nvme_target])
+_HYSTERESIS = np.array([TEMP_HYSTERESIS, NVME_HYSTERESIS])
+GREEDY = (-1, -1)  # Action placeholder: let q_step pick the best known action
+_rng = np.random.default_rng()
+
+# Dense Q-table shape: [rad_bucket, nvme_bucket, rad_action_idx, chs_action_idx]
+Q_STATE_BUCKETS = 64
+Q_SHAPE = (Q_STATE_BUCKETS, Q_STATE_BUCKETS, len(rad_speeds), len(chs_speeds))
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--debug", action="store_true", help="Enable debug logging")
 parser.add_argument("--reset-qtable", action="store_true", help="Reset Q-table")
@@ -46,221 +79,348 @@ logging.basicConfig(
     level=logging.DEBUG if args.debug else logging.INFO, 
     format='%(asctime)s [%(levelname)s] %(message)s'
 )
+logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+# Mail is sent from a background thread so the control loop never waits on fork/exec
+_mail_q = queue.Queue()
+_mail_last_minute = {}
+
+def _mail_worker():
+    while True:
+        subject, message = _mail_q.get()
+        try:
+            subprocess.run(['mail', '-s', subject, 'root'], input=message.encode(), check=True, timeout=30)
+        except Exception as e:
+            logging.error(f"Failed to send email: {e}")
+        finally:
+            _mail_q.task_done()
+
+threading.Thread(target=_mail_worker, daemon=True).start()
 
 def notify_root(subject, message):
+    """Queue an email to root; repeats of a subject within the same minute are dropped"""
+    minute = int(time.time() // 60)
+    if _mail_last_minute.get(subject) == minute:
+        return
+    _mail_last_minute[subject] = minute
+    _mail_q.put((subject, message))
+
+def release_device(device):
+    """Disconnect a liquidctl device, ignoring errors from an already-broken handle"""
+    try:
+        device.disconnect()
+    except Exception:
+        pass
+
+_QLOG_REC = struct.Struct('<BBBBf')  # s0, s1, ri, ci, q
+_qlog_fh = None
+
+def open_q_log():
+    """Open the Q-table delta log for buffered appends"""
+    global _qlog_fh
+    _qlog_fh = open(Q_TABLE_LOG, 'ab', buffering=65536)
+
+def append_q_delta(s0, s1, ri, ci, value):
+    """Append one fixed-size (state, action, q) record to the delta log"""
     try:
-        subprocess.run(['mail', '-s', subject, 'root'], input=message.encode(), check=True)
+        _qlog_fh.write(_QLOG_REC.pack(s0, s1, ri, ci, value))
     except Exception as e:
-        logging.error(f"Failed to send email: {e}")
+        logging.error(f"Failed to append Q-table delta: {e}")
+
+def flush_q_log():
+    """Hand buffered delta records to the OS (no fsync) so a killed process keeps them"""
+    try:
+        _qlog_fh.flush()
+    except Exception as e:
+        logging.error(f"Failed to flush Q-table delta log: {e}")
+
+def find_nvme_devices():
+    """List NVMe namespace-1 block devices under /dev"""
+    with os.scandir('/dev') as entries:
+        return [f'/dev/{e.name}' for e in entries
+                if e.name.startswith('nvme') and e.name.endswith('n1')]
+
+def count_q_states(q_table):
+    """Number of states with at least one learned Q-value"""
+    return int(np.count_nonzero(q_table.any(axis=(2, 3))))
 
 def save_q_table(q_table):
-    """Save Q-table to disk for persistence"""
+    """Compact the Q-table into a full snapshot and truncate the delta log"""
     try:
-        # Convert tuple keys to strings for JSON serialization
-        q_serializable = {}
-        for state, actions in q_table.items():
-            state_key = f"{state[0]}_{state[1]}"
-            q_serializable[state_key] = {}
-            for action, value in actions.items():
-                action_key = f"{action[0]}_{action[1]}"
-                q_serializable[state_key][action_key] = value
-        
-        with open(Q_TABLE_FILE, 'w') as f:
-            json.dump(q_serializable, f, indent=2)
-        logging.debug(f"Q-table saved with {len(q_table)} states")
+        tmp_file = Q_TABLE_FILE + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, q_table)
+        os.replace(tmp_file, Q_TABLE_FILE)
+        if _qlog_fh is not None:
+            _qlog_fh.flush()
+            _qlog_fh.truncate(0)
+        logging.debug(f"Q-table saved with {count_q_states(q_table)} states")
     except Exception as e:
         logging.error(f"Failed to save Q-table: {e}")
 
+def load_legacy_q_table(q_table, tried):
+    """Import the JSON Q-table of older versions into the dense arrays, returning the entry count"""
+    with open(LEGACY_Q_TABLE_FILE, 'r') as f:
+        legacy = json.load(f)
+    imported = 0
+    for state_key, actions in legacy.items():
+        s0, s1 = (int(part) for part in state_key.split('_'))
+        for action_key, value in actions.items():
+            rad, chs = (int(part) for part in action_key.split('_'))
+            if 0 <= s0 < Q_STATE_BUCKETS and 0 <= s1 < Q_STATE_BUCKETS and rad in _RAD_SPEED_IDX and chs in _CHS_SPEED_IDX:
+                q_table[s0, s1, _RAD_SPEED_IDX[rad], _CHS_SPEED_IDX[chs]] = value
+                tried[s0, s1, _RAD_SPEED_IDX[rad], _CHS_SPEED_IDX[chs]] = True
+                imported += 1
+    return imported
+
 def load_q_table():
-    """Load Q-table from disk"""
-    if not os.path.exists(Q_TABLE_FILE) or args.reset_qtable:
+    """Load Q-table snapshot from disk and replay the delta log.
+
+    Returns (q_table, tried), where tried marks actions taken at least once.
+    """
+    q_table = np.zeros(Q_SHAPE, dtype=np.float32)
+    tried = np.zeros(Q_SHAPE, dtype=np.bool_)
+    if args.reset_qtable:
         logging.info("Initializing new Q-table")
-        return {}
-    
+        if os.path.exists(Q_TABLE_LOG):
+            os.remove(Q_TABLE_LOG)
+        # An empty snapshot also keeps the legacy JSON table from being imported later
+        save_q_table(q_table)
+        return q_table, tried
+
     try:
-        with open(Q_TABLE_FILE, 'r') as f:
-            q_serializable = json.load(f)
-        
-        # Convert string keys back to tuples
-        q_table = {}
-        for state_key, actions in q_serializable.items():
-            state_parts = state_key.split('_')
-            state = (int(state_parts[0]), int(state_parts[1]))
-            q_table[state] = {}
-            for action_key, value in actions.items():
-                action_parts = action_key.split('_')
-                action = (int(action_parts[0]), int(action_parts[1]))
-                q_table[state][action] = value
-        
-        logging.info(f"Q-table loaded with {len(q_table)} states")
-        return q_table
+        if os.path.exists(Q_TABLE_FILE):
+            snapshot = np.load(Q_TABLE_FILE)
+            if snapshot.shape == Q_SHAPE:
+                q_table[...] = snapshot
+                # Snapshots do not store the mask, so nonzero entries stand in for it
+                tried |= q_table != 0
+            else:
+                logging.warning(f"Ignoring Q-table with shape {snapshot.shape}, expected {Q_SHAPE}")
+        elif os.path.exists(LEGACY_Q_TABLE_FILE):
+            # One-time import: the snapshot written here takes over on later starts
+            imported = load_legacy_q_table(q_table, tried)
+            save_q_table(q_table)
+            logging.info(f"Imported {imported} Q-values from {LEGACY_Q_TABLE_FILE}")
     except Exception as e:
         logging.error(f"Failed to load Q-table: {e}")
-        return {}
+
+    # Replay deltas written since the last snapshot; a torn tail record is ignored
+    replayed = 0
+    try:
+        if os.path.exists(Q_TABLE_LOG):
+            with open(Q_TABLE_LOG, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % _QLOG_REC.size
+            for s0, s1, ri, ci, value in _QLOG_REC.iter_unpack(data[:usable]):
+                q_table[s0, s1, ri, ci] = value
+                tried[s0, s1, ri, ci] = True
+                replayed += 1
+    except Exception as e:
+        logging.error(f"Failed to replay Q-table log: {e}")
+
+    q_states = count_q_states(tried)
+    if q_states:
+        logging.info(f"Q-table loaded with {q_states} states ({replayed} deltas replayed)")
+    else:
+        logging.info("Initializing new Q-table")
+    return q_table, tried
 
 def bucket(temp, step=3):
     """Bucket temperatures for state representation"""
-    return int(temp // step)
-
-def get_possible_actions():
-    """Generate all possible fan speed combinations"""
-    actions = []
-    for rad_speed in range(rad_min, rad_max + 1, fan_step):
-        for chs_speed in range(chs_min, chs_max + 1, fan_step):
-            actions.append((rad_speed, chs_speed))
-    return actions
-
-def choose_action(state, q_table, epsilon_current):
-    """Epsilon-greedy action selection"""
-    if state not in q_table or np.random.random() < epsilon_current:
+    return min(max(int(temp // step), 0), Q_STATE_BUCKETS - 1)
+
+def choose_action(state, tried, epsilon_current):
+    """Epsilon-greedy action selection, returns (ri, ci) speed indices or GREEDY"""
+    if not tried[state].any() or _rng.random() < epsilon_current:
         # Exploration: random action
-        possible_actions = get_possible_actions()
-        action = possible_actions[np.random.randint(len(possible_actions))]
-        logging.debug(f"Exploration: chose random action {action}")
+        action = divmod(int(_rng.integers(N_ACTIONS)), len(chs_speeds))
+        logging.debug(f"Exploration: chose random action {(_RAD_SPEED_VALUES[action[0]], _CHS_SPEED_VALUES[action[1]])}")
         return action
     
-    # Exploitation: best known action
-    best_action = max(q_table[state], key=q_table[state].get)
-    logging.debug(f"Exploitation: chose best action {best_action}")
-    return best_action
-
-def calculate_reward(temp_rad, temp_nvme, fan_rad, fan_chs):
-    """Optimized reward function for current excellent temperature ranges"""
-    reward = 0
-    
+    # Exploitation: resolved inside q_step with the rest of the numeric work
+    return GREEDY
+
+@njit(cache=True)
+def q_step(Q, tried, s0, s1, ri, ci, temp_rad, temp_nvme, rad_speeds, chs_speeds,
+           alpha, gamma, targets, hysteresis):
+    """Score every action, pick the greedy one when ri < 0 and update Q in place.
+
+    Only tried actions compete for the greedy pick and the bootstrap max, so the
+    zeros of untried actions never outrank a negative learned value.
+    Returns (ri, ci, reward) for the applied action.
+    """
     # Radiator temperature reward/penalty (much more generous)
-    rad_error = abs(temp_rad - temp_target)
-    if rad_error <= TEMP_HYSTERESIS:
+    rad_error = abs(temp_rad - targets[0])
+    if rad_error <= hysteresis[0]:
         # Perfect zone
-        reward += 30 - rad_error * 1  
+        temp_reward = 30.0 - rad_error
     elif rad_error <= 6:  # Excellent zone (covers current 30.3°C vs 35°C)
-        reward += 20 - rad_error * 0.5  # Still very positive
+        temp_reward = 20.0 - rad_error * 0.5  # Still very positive
     elif rad_error <= 10:
         # Good zone
-        reward += 10 - rad_error * 1
+        temp_reward = 10.0 - rad_error
     else:
         # Too far from target
-        reward -= rad_error * 2
+        temp_reward = -rad_error * 2
     
     # NVMe temperature reward/penalty (much more generous)
-    nvme_error = abs(temp_nvme - nvme_target)
-    if nvme_error <= NVME_HYSTERESIS:
+    nvme_error = abs(temp_nvme - targets[1])
+    if nvme_error <= hysteresis[1]:
         # Perfect zone
-        reward += 25 - nvme_error * 1
+        temp_reward += 25.0 - nvme_error
     elif nvme_error <= 10:  # Excellent zone (covers current 52°C vs 60°C)
-        reward += 18 - nvme_error * 0.3  # Still very positive
+        temp_reward += 18.0 - nvme_error * 0.3  # Still very positive
     elif nvme_error <= 15:
         # Good zone
-        reward += 8 - nvme_error * 0.8
+        temp_reward += 8.0 - nvme_error * 0.8
     else:
         # Too far from target
-        reward -= nvme_error * 1.5
+        temp_reward -= nvme_error * 1.5
     
-    # Minimal noise penalty
-    noise_factor = (fan_rad + fan_chs) / 200.0
-    reward -= noise_factor * 3  # Very low noise penalty
+    # Big efficiency bonus when temps are great, extra bonus below targets
+    temps_excellent = rad_error <= 6 and nvme_error <= 10
+    if temps_excellent and temp_rad <= targets[0] and temp_nvme <= targets[1]:
+        temp_reward += 8.0
     
-    # Big efficiency bonus when temps are great
-    if rad_error <= 6 and nvme_error <= 10:
-        # Both temps excellent, big efficiency reward
-        efficiency_bonus = (200 - fan_rad - fan_chs) / 200.0 * 12
-        reward += efficiency_bonus
-        
-        # Extra bonus for being below targets (like current situation)
-        if temp_rad <= temp_target and temp_nvme <= nvme_target:
-            cool_bonus = 8
-            reward += cool_bonus
+    q_row = Q[s0, s1]
+    tried_row = tried[s0, s1]
+    n_rad, n_chs = q_row.shape
+    rewards = np.empty((n_rad, n_chs))
+    best_q = -np.inf
+    best_ri = 0
+    best_ci = 0
+    for i in range(n_rad):
+        for j in range(n_chs):
+            fan_sum = rad_speeds[i] + chs_speeds[j]
+            # Minimal noise penalty
+            reward = temp_reward - fan_sum / 200.0 * 3
+            if temps_excellent:
+                reward += (200 - fan_sum) / 200.0 * 12
+            rewards[i, j] = reward
+            if tried_row[i, j] and q_row[i, j] > best_q:
+                best_q = q_row[i, j]
+                best_ri = i
+                best_ci = j
     
-    return reward
-
-# Initialize data file if it doesn't exist
-if not os.path.exists(DATA_FILE):
-    with open(DATA_FILE, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['timestamp', 'temp_rad', 'temp_nvme', 'fan_rad', 'fan_chs', 
-                        'noise_est', 'reward', 'epsilon', 'q_states'])
+    if ri < 0:
+        ri = best_ri
+        ci = best_ci
+    reward = rewards[ri, ci]
+    # The applied action counts as tried for its own bootstrap
+    best_q = max(best_q, q_row[ri, ci])
+    q_row[ri, ci] += alpha * (reward + gamma * best_q - q_row[ri, ci])
+    tried_row[ri, ci] = True
+    return ri, ci, reward
+
+# Data record: timestamp (epoch), temp_rad, temp_nvme, fan_rad, fan_chs,
+# noise_est, reward, epsilon, q_states. The dashboard reads it with a matching dtype.
+DATA_REC = struct.Struct('<dfffffffi')
+
+# Data file stays open for the process lifetime; records are block-buffered
+_bin_fh = open(DATA_FILE, 'ab', buffering=65536)
 
 # Load Q-table
-Q = load_q_table()
+Q, Q_TRIED = load_q_table()  # Q_TRIED: actions taken at least once
+open_q_log()
 
 # Initialize variables
-temp_rad_hist = []
-temp_nvme_hist = []
+q_states = count_q_states(Q_TRIED)
+temp_rad_hist = deque(maxlen=5)  # Short history for faster response
+temp_nvme_hist = deque(maxlen=5)
+_rad_sum = 0.0
+_nvme_sum = 0.0
 fan_rad_speed = 50
 fan_chs_speed = 50
 epsilon_current = epsilon
 save_counter = 0
+target_device = None
+nvme_devices = None
+_last_rad_speed = _last_chs_speed = None  # Speeds last written to the device
 
 notify_root("Fan Monitor Started", "Improved Q-learning fan monitor is now active.")
 logging.info(f"Starting with epsilon={epsilon}, targets: RAD={temp_target}°C, NVMe={nvme_target}°C")
 
 try:
     while True:
-        timestamp = datetime.now().isoformat()
+        ts_epoch = time.time()
         save_counter += 1
 
-        # Find and connect to liquidctl device
-        devices = list(find_liquidctl_devices())
-        logging.debug(f"Found {len(devices)} liquidctl devices.")
-        if not devices:
-            logging.warning("No liquidctl devices found.")
-            time.sleep(10)
-            continue
-
-        target_device = None
-        for dev in devices:
-            if "Commander Core XT" in dev.description:
-                target_device = dev
-                break
+        # Find and connect to liquidctl device once; the handle is kept open
+        # across iterations and only re-opened after an I/O error
+        if target_device is None:
+            devices = list(find_liquidctl_devices())
+            logging.debug(f"Found {len(devices)} liquidctl devices.")
+            if not devices:
+                logging.warning("No liquidctl devices found.")
+                time.sleep(10)
+                continue
+
+            for dev in devices:
+                if "Commander Core XT" in dev.description:
+                    target_device = dev
+                    break
+
+            if not target_device:
+                logging.error("Commander Core XT not found among devices.")
+                time.sleep(10)
+                continue
 
-        if not target_device:
-            logging.error("Commander Core XT not found among devices.")
-            time.sleep(10)
-            continue
+            try:
+                target_device.connect()
+                logging.debug(f"Connected to device: {target_device.description}")
+            except Exception as e:
+                logging.error(f"Error connecting to liquidctl device: {e}")
+                target_device = None
+                time.sleep(10)
+                continue
 
         # Read radiator temperatures
         temp_rad_in = None
         temp_rad_out = None
 
         try:
-            with target_device.connect():
-                status = target_device.get_status()
-                logging.debug(f"Connected to device: {target_device.description}")
-                for key, value, unit in status:
-                    logging.debug(f"{key}: {value} {unit}")
-                    if "Temperature" in key and "0" in key:
-                        try:
-                            temp_rad_out = float(str(value).replace("°C", "").strip())
-                        except Exception as e:
-                            logging.warning(f"Failed to parse temp_rad_out: {value} - {e}")
-                    elif "Temperature" in key and "1" in key:
-                        try:
-                            temp_rad_in = float(str(value).replace("°C", "").strip())
-                        except Exception as e:
-                            logging.warning(f"Failed to parse temp_rad_in: {value} - {e}")
-                logging.debug(f"Radiator IN: {temp_rad_in}°C, OUT: {temp_rad_out}°C")
+            status = target_device.get_status()
+            rad_temps = {}
+            for key, value, unit in status:
+                logging.debug(f"{key}: {value} {unit}")
+                which = _TEMP_KEYS.get(key)
+                if which:
+                    try:
+                        rad_temps[which] = value if isinstance(value, (int, float)) else float(str(value).split()[0])
+                    except Exception as e:
+                        logging.warning(f"Failed to parse temp_rad_{which}: {value} - {e}")
+            temp_rad_out = rad_temps.get('out')
+            temp_rad_in = rad_temps.get('in')
+            logging.debug(f"Radiator IN: {temp_rad_in}°C, OUT: {temp_rad_out}°C")
+        except OSError as e:
+            logging.error(f"Lost connection to liquidctl device: {e}")
+            release_device(target_device)
+            target_device = None
+            time.sleep(10)
+            continue
         except Exception as e:
             logging.error(f"Error accessing liquidctl device: {e}")
             time.sleep(10)
             continue
 
         # Read NVMe temperatures
-        nvme_devices = glob.glob('/dev/nvme*n1')
-        logging.debug(f"Detected NVMe devices: {[os.path.basename(dev) for dev in nvme_devices]}")
+        if nvme_devices is None:
+            nvme_devices = find_nvme_devices()
+            logging.debug(f"Detected NVMe devices: {[os.path.basename(dev) for dev in nvme_devices]}")
         nvme_temps = []
         for dev in nvme_devices:
             try:
-                result = subprocess.run(['nvme', 'smart-log', dev], capture_output=True, text=True)
-                for line in result.stdout.splitlines():
-                    if "temperature" in line.lower() and "sensor" not in line.lower():
-                        parts = line.split(":")
-                        if len(parts) == 2:
-                            temp_str = parts[1].strip().split(" ")[0].replace("°C", "")
-                            nvme_temp = float(temp_str)
-                            if nvme_temp > 0:
-                                nvme_temps.append(nvme_temp)
+                result = subprocess.run(['nvme', 'smart-log', '-o', 'json', dev], capture_output=True, text=True)
+                data = json.loads(result.stdout)
+                # nvme-cli reports the composite temperature in Kelvin
+                temp_k = data.get('temperature', 0)
+                nvme_temp = temp_k - 273 if temp_k > 200 else temp_k
+                if nvme_temp > 0:
+                    nvme_temps.append(nvme_temp)
             except Exception as e:
                 logging.warning(f"Could not read NVMe temp from {dev}: {e}")
+                nvme_devices = None  # Re-scan /dev on the next iteration
 
         temp_nvme = max(nvme_temps) if nvme_temps else 0.0
 
@@ -270,60 +430,67 @@ try:
             continue
 
         # Update temperature history
+        if len(temp_rad_hist) == temp_rad_hist.maxlen:
+            _rad_sum -= temp_rad_hist[0]
+            _nvme_sum -= temp_nvme_hist[0]
         temp_rad_hist.append(temp_rad_in)
         temp_nvme_hist.append(temp_nvme)
-        if len(temp_rad_hist) > 5:  # Reduced history for faster response
-            temp_rad_hist.pop(0)
-            temp_nvme_hist.pop(0)
+        _rad_sum += temp_rad_in
+        _nvme_sum += temp_nvme
 
-        temp_rad_avg = np.mean(temp_rad_hist)
-        temp_nvme_avg = np.mean(temp_nvme_hist)
+        temp_rad_avg = _rad_sum / len(temp_rad_hist)
+        temp_nvme_avg = _nvme_sum / len(temp_nvme_hist)
 
         # Define current state
         current_state = (bucket(temp_rad_avg), bucket(temp_nvme_avg))
         
         # Emergency override for critical temperatures
         if temp_rad_in > 65 or temp_nvme > 80:
-            fan_rad_speed = 100
-            fan_chs_speed = 100
+            action = (len(rad_speeds) - 1, len(chs_speeds) - 1)
             notify_root("🔥 Critical Temperature", 
-                       f"Emergency cooling activated! RAD: {temp_rad_avg:.1f}°C, NVMe: {temp_nvme_avg:.1f}°C at {timestamp}")
+                       f"Emergency cooling activated! RAD: {temp_rad_avg:.1f}°C, NVMe: {temp_nvme_avg:.1f}°C "
+                       f"at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts_epoch))}")
             logging.warning("Emergency cooling activated!")
         else:
             # Q-learning action selection
-            action = choose_action(current_state, Q, epsilon_current)
-            fan_rad_speed, fan_chs_speed = action
-
-        # Calculate reward for the previous state-action pair
-        reward = calculate_reward(temp_rad_avg, temp_nvme_avg, fan_rad_speed, fan_chs_speed)
-
-        # Update Q-table
-        if current_state not in Q:
-            Q[current_state] = {}
-        current_action = (fan_rad_speed, fan_chs_speed)
-        if current_action not in Q[current_state]:
-            Q[current_state][current_action] = 0.0
-
-        # Q-learning update rule
-        max_future_q = 0
-        if current_state in Q and Q[current_state]:
-            max_future_q = max(Q[current_state].values())
-        
-        Q[current_state][current_action] += alpha * (reward + gamma * max_future_q - Q[current_state][current_action])
-
-        # Apply fan speeds
+            action = choose_action(current_state, Q_TRIED, epsilon_current)
+
+        # Reward the applied action and run the Q-learning update
+        s0, s1 = current_state
+        if not Q_TRIED[s0, s1].any():
+            q_states += 1
+        rad_idx, chs_idx, reward = q_step(Q, Q_TRIED, s0, s1, action[0], action[1], temp_rad_avg, temp_nvme_avg,
+                                          rad_speeds, chs_speeds, alpha, gamma, _TARGETS, _HYSTERESIS)
+        append_q_delta(s0, s1, rad_idx, chs_idx, Q[s0, s1, rad_idx, chs_idx])
+        fan_rad_speed = _RAD_SPEED_VALUES[rad_idx]
+        fan_chs_speed = _CHS_SPEED_VALUES[chs_idx]
+        if action == GREEDY:
+            logging.debug(f"Exploitation: chose best action {(fan_rad_speed, fan_chs_speed)}")
+
+        # Apply fan speeds, skipping fan groups whose speed is unchanged
         try:
-            with target_device.connect():
+            if fan_rad_speed != _last_rad_speed:
                 # Radiator cooling fans (1, 2, 3)
                 target_device.set_fixed_speed("fan1", fan_rad_speed)
                 target_device.set_fixed_speed("fan2", fan_rad_speed)
                 target_device.set_fixed_speed("fan3", fan_rad_speed)
+                _last_rad_speed = fan_rad_speed
+            if fan_chs_speed != _last_chs_speed:
                 # NVMe cooling fans (4, 5, 6)
                 target_device.set_fixed_speed("fan4", fan_chs_speed)
                 target_device.set_fixed_speed("fan5", fan_chs_speed)
                 target_device.set_fixed_speed("fan6", fan_chs_speed)
+                _last_chs_speed = fan_chs_speed
+        except OSError as e:
+            logging.error(f"Lost connection to liquidctl device: {e}")
+            release_device(target_device)
+            target_device = None
+            _last_rad_speed = _last_chs_speed = None
+            time.sleep(10)
+            continue
         except Exception as e:
             logging.error(f"Failed to set fan speeds: {e}")
+            _last_rad_speed = _last_chs_speed = None
             time.sleep(10)
             continue
 
@@ -333,30 +500,38 @@ try:
         # Logging
         log_msg = (f"RAD: {temp_rad_avg:.1f}°C | NVMe: {temp_nvme_avg:.1f}°C | "
                   f"Fan R/C: {fan_rad_speed}%/{fan_chs_speed}% | Reward: {reward:.2f} | "
-                  f"ε: {epsilon_current:.3f} | Q-states: {len(Q)}")
+                  f"ε: {epsilon_current:.3f} | Q-states: {q_states}")
         logging.info(log_msg)
-        print(log_msg)
 
-        # Save data to CSV
-        with open(DATA_FILE, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([timestamp, temp_rad_avg, temp_nvme_avg, fan_rad_speed, 
-                           fan_chs_speed, (fan_rad_speed+fan_chs_speed)/2, reward, 
-                           epsilon_current, len(Q)])
+        # Save data record
+        _bin_fh.write(DATA_REC.pack(ts_epoch, temp_rad_avg, temp_nvme_avg, fan_rad_speed,
+                                    fan_chs_speed, (fan_rad_speed+fan_chs_speed)/2, reward,
+                                    epsilon_current, q_states))
+        if save_counter % DATA_FLUSH_INTERVAL == 0:
+            _bin_fh.flush()
+            flush_q_log()
 
-        # Save Q-table periodically
-        if save_counter % 30 == 0:  # Save every 5 minutes
+        # Compact Q-table snapshot periodically; deltas are already in the log
+        if save_counter % Q_COMPACT_INTERVAL == 0:
             save_q_table(Q)
-            logging.debug("Q-table saved to disk")
+            logging.debug("Q-table compacted to disk")
 
         time.sleep(10)
 
 except KeyboardInterrupt:
+    if target_device is not None:
+        release_device(target_device)
+    _bin_fh.close()
     save_q_table(Q)
     notify_root("Fan Monitor Stopped", "Fan monitor script exited via KeyboardInterrupt.")
+    _mail_q.join()
     logging.info("Service interrupted by user. Q-table saved.")
 
 except Exception as e:
+    if target_device is not None:
+        release_device(target_device)
+    _bin_fh.close()
     save_q_table(Q)
     notify_root("Fan Monitor Crashed", f"Unexpected error: {e}")
+    _mail_q.join()
     logging.exception("Unhandled exception. Q-table saved.")
\ No newline at end of file
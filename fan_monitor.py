@@ -16,6 +16,11 @@ import logging
 import subprocess
 import re
 import sys
+import os
+import signal
+import json
+import queue
+import threading
 from liquidctl import find_liquidctl_devices
 
 # Configuration
@@ -40,19 +45,26 @@ class TempColorFormatter(logging.Formatter):
     RED = '\033[91m'
     RESET = '\033[0m'
 
+    _TEMP_RE = re.compile(r'(\d+(?:\.\d+)?)\s*°C')
+
+    _BLUE_FMT = f'{BLUE}{{}}{RESET}'
+    _GREEN_FMT = f'{GREEN}{{}}{RESET}'
+    _YELLOW_FMT = f'{YELLOW}{{}}{RESET}'
+    _RED_FMT = f'{RED}{{}}{RESET}'
+
     def format(self, record):
         message = super().format(record)
-        temp_match = re.search(r'(\d+(?:\.\d+)?)\s*°C', message)
+        temp_match = self._TEMP_RE.search(message)
         if temp_match:
             temp = float(temp_match.group(1))
             if temp < 10:
-                return f"{self.BLUE}{message}{self.RESET}"
+                return self._BLUE_FMT.format(message)
             elif temp <= 40:
-                return f"{self.GREEN}{message}{self.RESET}"
+                return self._GREEN_FMT.format(message)
             elif 41 <= temp <= 60:
-                return f"{self.YELLOW}{message}{self.RESET}"
+                return self._YELLOW_FMT.format(message)
             else:
-                return f"{self.RED}{message}{self.RESET}"
+                return self._RED_FMT.format(message)
         return message
 
 # Setup logger
@@ -62,12 +74,29 @@ logging.getLogger().handlers = []
 logging.getLogger().addHandler(handler)
 logging.getLogger().setLevel(logging.INFO)
 
-# Email alerts
+# Email alerts (sent from a background thread so the control loop never blocks on 'mail')
+_mail_q = queue.Queue()
+_mail_last_minute = {}
+
+def _mail_worker():
+    while True:
+        subject, message = _mail_q.get()
+        try:
+            subprocess.run(['mail', '-s', subject, 'root'], input=message, text=True, check=True, timeout=30)
+        except Exception as e:
+            logging.error(f"Failed to send email '{subject}': {e}")
+        finally:
+            _mail_q.task_done()
+
+threading.Thread(target=_mail_worker, daemon=True).start()
+
 def send_email(subject, message):
-    try:
-        subprocess.run(['mail', '-s', subject, 'root'], input=message, text=True, check=True)
-    except Exception as e:
-        logging.error(f"Failed to send email '{subject}': {e}")
+    # Repeats of a subject within the same minute are dropped
+    minute = int(time.time() // 60)
+    if _mail_last_minute.get(subject) == minute:
+        return
+    _mail_last_minute[subject] = minute
+    _mail_q.put((subject, message))
 
 def notify_start():
     send_email("✅ Fan Monitor Started", "Monitoring started successfully.")
@@ -77,25 +106,43 @@ def notify_stop(reason="normal"):
         send_email("🛑 Fan Monitor Stopped", "Service stopped normally.")
     else:
         send_email("❌ Fan Monitor Crashed", f"Error: {reason}")
+    # Deliver pending mail before the process exits
+    _mail_q.join()
+
+# NVMe controller list is cached until SIGHUP; a controller whose read fails is dropped from it
+_nvme_cache = None
+
+def _reset_nvme_cache(*_):
+    global _nvme_cache
+    _nvme_cache = None
+
+signal.signal(signal.SIGHUP, _reset_nvme_cache)
 
 # Read NVMe temperatures (excluding Sensor 2)
 def get_nvme_temperatures():
+    global _nvme_cache
     temps = []
     try:
-        output = subprocess.check_output(['lsblk', '-dno', 'NAME,TYPE'], text=True)
-        devices = [line.split()[0] for line in output.splitlines() if 'nvme' in line and 'disk' in line]
-        for dev in devices:
+        if _nvme_cache is None:
+            try:
+                with os.scandir('/sys/class/nvme') as entries:
+                    _nvme_cache = sorted(e.name for e in entries if e.name.startswith('nvme'))
+            except FileNotFoundError:
+                _nvme_cache = []  # No NVMe controllers on this host
+        devices = _nvme_cache  # Local reference: a SIGHUP mid-loop only resets the global
+        for dev in list(devices):
             try:
-                data = subprocess.check_output(['smartctl', '-A', f'/dev/{dev}'], text=True).splitlines()
-                for line in data:
-                    match = re.match(r'(Temperature.*?)\s*:\s*(\d+)', line)
-                    if match:
-                        label = match.group(1).strip()
-                        temp = int(match.group(2))
-                        if "Sensor 2" not in label and temp > 0:
-                            temps.append((f"{dev} ({label})", temp))
+                data = json.loads(subprocess.check_output(['smartctl', '-A', '-j', f'/dev/{dev}'], text=True))
+                health = data.get('nvme_smart_health_information_log', {})
+                temp = health.get('temperature', data.get('temperature', {}).get('current', 0))
+                if temp > 0:
+                    temps.append((f"{dev} (Temperature)", temp))
+                for i, temp in enumerate(health.get('temperature_sensors', []), start=1):
+                    if i != 2 and temp > 0:
+                        temps.append((f"{dev} (Temperature Sensor {i})", temp))
             except Exception as e:
                 logging.warning(f"Failed to read /dev/{dev}: {e}")
+                devices.remove(dev)
     except Exception as e:
         logging.error(f"Failed to list NVMe devices: {e}")
     return temps
@@ -117,13 +164,15 @@ def main():
     chs_speed = FAN_SPEED_INITIAL
     last_rad = last_chs = None
 
+    # Keep one connection open for the whole run; reconnect only after an I/O error
     try:
-        with commander.connect():
-            logging.info("Initializing device...")
-            commander.initialize()
+        commander.connect()
+        logging.info("Initializing device...")
+        commander.initialize()
     except Exception as e:
         notify_stop(f"Initialization error: {e}")
         return 1
+    connected = True
 
     while True:
         try:
@@ -133,58 +182,71 @@ def main():
             for label, temp in nvme_temps:
                 logging.info(f"NVMe {label}: {temp:.1f}°C")
 
-            with commander.connect():
-                status = commander.get_status()
-                temp_in = temp_out = None
-                for key, val, unit in status:
-                    if key == "Temperature 1":
-                        temp_in = float(val)
-                        logging.info(f"Radiator IN: {temp_in:.1f}°C")
-                    elif key == "Temperature 0":
-                        temp_out = float(val)
-                        logging.info(f"Radiator OUT: {temp_out:.1f}°C")
-                if temp_in is not None and temp_out is not None:
-                    delta = round(temp_in - temp_out, 2)
-                    logging.info(f"Radiator ΔT: {delta:.2f}°C")
-
-                # Emergency trigger
-                if (temp_in and temp_in > CRITICAL_RADIATOR_TEMP) or any(t > CRITICAL_NVME_TEMP for _, t in nvme_temps):
-                    reason = f"CRITICAL TEMP — Radiator IN: {temp_in:.1f}°C, NVMe MAX: {max_nvme:.1f}°C"
-                    logging.critical(reason)
-                    for i in range(1, 6):
-                        commander.set_fixed_speed(f"fan{i}", 100)
-                    send_email("⚠️ CRITICAL TEMPERATURE", reason)
-                    continue
-
-                # Radiator fan control
-                if temp_in:
-                    if temp_in > RADIATOR_TEMP_MAX:
-                        rad_speed = min(rad_speed + 5, FAN_SPEED_MAX)
-                    elif temp_in < (RADIATOR_TEMP_MIN - FAN_HYSTERESIS):
-                        rad_speed = max(rad_speed - 5, FAN_SPEED_MIN)
-
-                # Chassis fan control
-                if max_nvme > NVME_TEMP_MAX:
-                    chs_speed = min(chs_speed + 5, FAN_SPEED_MAX)
-                elif max_nvme < (NVME_TEMP_MIN - FAN_HYSTERESIS):
-                    chs_speed = max(chs_speed - 5, FAN_SPEED_MIN)
-
-                if rad_speed != last_rad:
-                    for i in range(1, 4):
-                        commander.set_fixed_speed(f"fan{i}", rad_speed)
-                    last_rad = rad_speed
-                    logging.info(f"Radiator fans set to {rad_speed}%")
-
-                if chs_speed != last_chs:
-                    for i in range(4, 6):
-                        commander.set_fixed_speed(f"fan{i}", chs_speed)
-                    last_chs = chs_speed
-                    logging.info(f"Chassis fans set to {chs_speed}%")
+            if not connected:
+                commander.connect()
+                connected = True
+
+            status = commander.get_status()
+            temp_in = temp_out = None
+            for key, val, unit in status:
+                if key == "Temperature 1":
+                    temp_in = float(val)
+                    logging.info(f"Radiator IN: {temp_in:.1f}°C")
+                elif key == "Temperature 0":
+                    temp_out = float(val)
+                    logging.info(f"Radiator OUT: {temp_out:.1f}°C")
+            if temp_in is not None and temp_out is not None:
+                delta = round(temp_in - temp_out, 2)
+                logging.info(f"Radiator ΔT: {delta:.2f}°C")
+
+            # Emergency trigger
+            if (temp_in and temp_in > CRITICAL_RADIATOR_TEMP) or any(t > CRITICAL_NVME_TEMP for _, t in nvme_temps):
+                reason = f"CRITICAL TEMP — Radiator IN: {temp_in:.1f}°C, NVMe MAX: {max_nvme:.1f}°C"
+                logging.critical(reason)
+                for i in range(1, 6):
+                    commander.set_fixed_speed(f"fan{i}", 100)
+                send_email("⚠️ CRITICAL TEMPERATURE", reason)
+                continue
+
+            # Radiator fan control
+            if temp_in:
+                if temp_in > RADIATOR_TEMP_MAX:
+                    rad_speed = min(rad_speed + 5, FAN_SPEED_MAX)
+                elif temp_in < (RADIATOR_TEMP_MIN - FAN_HYSTERESIS):
+                    rad_speed = max(rad_speed - 5, FAN_SPEED_MIN)
+
+            # Chassis fan control
+            if max_nvme > NVME_TEMP_MAX:
+                chs_speed = min(chs_speed + 5, FAN_SPEED_MAX)
+            elif max_nvme < (NVME_TEMP_MIN - FAN_HYSTERESIS):
+                chs_speed = max(chs_speed - 5, FAN_SPEED_MIN)
+
+            if rad_speed != last_rad:
+                for i in range(1, 4):
+                    commander.set_fixed_speed(f"fan{i}", rad_speed)
+                last_rad = rad_speed
+                logging.info(f"Radiator fans set to {rad_speed}%")
+
+            if chs_speed != last_chs:
+                for i in range(4, 6):
+                    commander.set_fixed_speed(f"fan{i}", chs_speed)
+                last_chs = chs_speed
+                logging.info(f"Chassis fans set to {chs_speed}%")
 
         except KeyboardInterrupt:
             logging.info("Service interrupted by user.")
+            if connected:
+                commander.disconnect()
             notify_stop("normal")
             sys.exit(0)
+        except OSError as e:
+            logging.error(f"Lost connection to Commander Core XT: {e}")
+            try:
+                commander.disconnect()
+            except Exception:
+                pass
+            connected = False
+            last_rad = last_chs = None
         except Exception as e:
             logging.error(f"Unhandled exception: {e}")
             notify_stop(str(e))
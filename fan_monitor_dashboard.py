@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import os
@@ -7,6 +8,59 @@ from datetime import datetime, time
 from streamlit_autorefresh import st_autorefresh
 
 DATA_FILE = '/var/log/fan_monitor_data.csv'
+DATA_FILE_BIN = '/var/log/fan_monitor_data.bin'
+DATA_DIR_PARQUET = '/var/log/fan_monitor_data.parquet'  # Dataset escrito com --parquet
+
+# Layout of the binary records written by claude.py (struct '<dfffffffi')
+_np_dtype = np.dtype([
+    ('timestamp', '<f8'), ('temp_rad', '<f4'), ('temp_nvme', '<f4'),
+    ('fan_rad', '<f4'), ('fan_chs', '<f4'), ('noise_est', '<f4'),
+    ('reward', '<f4'), ('epsilon', '<f4'), ('q_states', '<i4'),
+])
+
+# Colunas numéricas do CSV em float32 para reduzir memória
+CSV_DTYPES = {'temp_rad': 'float32', 'temp_nvme': 'float32', 'fan_rad': 'float32',
+              'fan_chs': 'float32', 'noise_est': 'float32', 'reward': 'float32'}
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_full(path, mtime, size):
+    """Lê o CSV inteiro (cache por mtime/tamanho)."""
+    df = pd.read_csv(path, dtype=CSV_DTYPES)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='mixed')
+    return df
+
+def load_tail(path, start_row, columns):
+    """Lê apenas as linhas adicionadas após as primeiras start_row (sem cache: o resultado fica em session_state)."""
+    df = pd.read_csv(path, skiprows=range(1, start_row + 1), header=0,
+                     names=list(columns), dtype=CSV_DTYPES)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='mixed')
+    return df
+
+def ends_with_newline(path, size):
+    """Indica se a última linha do arquivo está completa."""
+    if size == 0:
+        return True
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_parquet(path, mtime):
+    """Lê o dataset Parquet (cache pelo mtime do diretório, que muda a cada novo arquivo)."""
+    return pd.read_parquet(path, engine='pyarrow')
+
+def latest_source():
+    """Escolhe a fonte de dados ('bin', 'parquet' ou 'csv') modificada mais recentemente."""
+    candidates = []
+    for kind, path in (('bin', DATA_FILE_BIN), ('parquet', DATA_DIR_PARQUET), ('csv', DATA_FILE)):
+        try:
+            candidates.append((os.stat(path).st_mtime, kind, path))
+        except OSError:
+            pass
+    if not candidates:
+        return None, None
+    _, kind, path = max(candidates)
+    return kind, path
 
 st.set_page_config(page_title='Fan Monitor Dashboard', layout='wide')
 st.title('🌀 Fan Monitor with Q-learning')
@@ -15,23 +69,76 @@ st.markdown('Visualização dos dados térmicos e de aprendizado do sistema.')
 # 🔄 Auto-refresh a cada 30 segundos (mantém estado)
 st_autorefresh(interval=30 * 1000, key="data_refresh")
 
-if not os.path.exists(DATA_FILE):
-    st.warning(f'Data file not found: {DATA_FILE}')
+# Fonte ativa: a escrita mais recentemente (um .bin antigo do claude.py não esconde o CSV/Parquet atual)
+source, source_path = latest_source()
+if source is not None:
+    st.caption(f'Fonte de dados: {source_path}')
+
+if source == 'bin':
+    # Registros binários: leitura direta, sem tokenização por linha
+    try:
+        n_records = os.path.getsize(DATA_FILE_BIN) // _np_dtype.itemsize
+        arr = np.fromfile(DATA_FILE_BIN, dtype=_np_dtype, count=n_records)
+        df = pd.DataFrame(arr)
+    except Exception as e:
+        st.error(f'Error reading binary data: {e}')
+        st.stop()
+
+    if df.empty:
+        st.warning("O arquivo de dados está vazio.")
+        st.stop()
+
+    # Epoch (UTC) -> horário local, como no CSV
+    local_tz = datetime.now().astimezone().tzinfo
+    df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s', utc=True).dt.tz_convert(local_tz).dt.tz_localize(None)
+elif source == 'parquet':
+    # Dataset Parquet: leitura colunar em C++, sem parsing de texto
+    try:
+        df = load_parquet(DATA_DIR_PARQUET, os.stat(DATA_DIR_PARQUET).st_mtime)
+    except Exception as e:
+        st.error(f'Error reading Parquet data: {e}')
+        st.stop()
+
+    if df.empty:
+        st.warning("O dataset Parquet está vazio.")
+        st.stop()
+
+    df = df.sort_values('timestamp', ignore_index=True)
+elif source == 'csv':
+    # Leitura incremental: só as linhas novas desde o último refresh são parseadas
+    stat = os.stat(DATA_FILE)
+    last_size = st.session_state.get('last_size')
+    try:
+        # Linha final ainda sendo escrita: descartada só do que acabou de ser lido e relida inteira depois
+        partial = not ends_with_newline(DATA_FILE, stat.st_size)
+        if last_size is None or stat.st_size < last_size:
+            # Primeira leitura ou arquivo truncado/rotacionado
+            df = load_full(DATA_FILE, stat.st_mtime, stat.st_size)
+            if partial and len(df):
+                df = df.iloc[:-1]
+        elif stat.st_size > last_size:
+            cached = st.session_state['csv_df']
+            tail = load_tail(DATA_FILE, st.session_state['last_rows'], tuple(cached.columns))
+            if partial and len(tail):
+                tail = tail.iloc[:-1]
+            df = pd.concat([cached, tail], ignore_index=True)
+        else:
+            df = st.session_state['csv_df']
+    except Exception as e:
+        st.error(f'Error reading CSV: {e}')
+        st.stop()
+
+    st.session_state['csv_df'] = df
+    st.session_state['last_rows'] = len(df)
+    st.session_state['last_size'] = stat.st_size
+
+    if df.empty:
+        st.warning("O arquivo CSV está vazio.")
+        st.stop()
+else:
+    st.warning(f'Data file not found: {DATA_FILE_BIN} / {DATA_DIR_PARQUET} / {DATA_FILE}')
     st.stop()
 
-try:
-    df = pd.read_csv(DATA_FILE, parse_dates=['timestamp'])
-except Exception as e:
-    st.error(f'Error reading CSV: {e}')
-    st.stop()
-
-if df.empty:
-    st.warning("O arquivo CSV está vazio.")
-    st.stop()
-
-#df['timestamp'] = pd.to_datetime(df['timestamp'])
-df['timestamp'] = pd.to_datetime(df['timestamp'], format='mixed')
-
 # 🎛️ Filtros na barra lateral com session_state
 st.sidebar.header("🔍 Filtros")
 
@@ -52,10 +159,20 @@ if df.empty:
     st.warning("Nenhum dado disponível no intervalo selecionado.")
     st.stop()
 
-# 📉 Downsample e suavização
-df = df.iloc[::6]
-df['fan_rad_avg'] = df['fan_rad'].rolling(window=6, min_periods=1).mean()
-df['fan_chs_avg'] = df['fan_chs'].rolling(window=6, min_periods=1).mean()
+# 📉 Downsample e suavização em uma única passada: médias por blocos de 6 amostras
+NUM_COLS = ['temp_rad', 'temp_nvme', 'fan_rad', 'fan_chs', 'noise_est', 'reward']
+df = df.astype(dict.fromkeys(NUM_COLS, 'float32'))
+df = df.groupby(np.arange(len(df)) // 6).agg(
+    timestamp=('timestamp', 'first'),
+    temp_rad=('temp_rad', 'mean'),
+    temp_nvme=('temp_nvme', 'mean'),
+    fan_rad=('fan_rad', 'last'),
+    fan_chs=('fan_chs', 'last'),
+    fan_rad_avg=('fan_rad', 'mean'),
+    fan_chs_avg=('fan_chs', 'mean'),
+    noise_est=('noise_est', 'mean'),
+    reward=('reward', 'mean'),
+)
 
 # 📊 Últimos valores
 st.markdown("### 📊 Últimos valores")
@@ -66,20 +183,20 @@ col2.metric("NVMe Temp (°C)", f"{latest['temp_nvme']:.1f}")
 col3.metric("Fan Radiator (%)", int(latest['fan_rad']))
 col4.metric("Fan Chassis (%)", int(latest['fan_chs']))
 
-# 📈 Temperaturas
+# 📈 Temperaturas (gráficos em WebGL: um único canvas em vez de nós SVG)
 st.markdown("### 📈 Temperaturas")
 fig_temp = px.line(df, x='timestamp', y=['temp_rad', 'temp_nvme'],
-                   labels={'value': '°C', 'timestamp': 'Horário'}, 
-                   title='Temperaturas Radiador / NVMe')
+                   labels={'value': '°C', 'timestamp': 'Horário'},
+                   title='Temperaturas Radiador / NVMe', render_mode='webgl')
 fig_temp.update_layout(paper_bgcolor='white', plot_bgcolor='white')
 st.plotly_chart(fig_temp, use_container_width=True)
 
 # 🔊 Ruído e recompensa
 st.markdown("### 🔊 Ruído e Recompensa")
 fig_nr = go.Figure()
-fig_nr.add_trace(go.Scatter(x=df['timestamp'], y=df['noise_est'],
+fig_nr.add_trace(go.Scattergl(x=df['timestamp'], y=df['noise_est'],
                             mode='lines', name='Ruído Estimado', line=dict(color='orange')))
-fig_nr.add_trace(go.Scatter(x=df['timestamp'], y=df['reward'],
+fig_nr.add_trace(go.Scattergl(x=df['timestamp'], y=df['reward'],
                             mode='lines', name='Recompensa', yaxis='y2', line=dict(color='green')))
 fig_nr.update_layout(
     xaxis=dict(domain=[0.1, 0.9]),
@@ -96,6 +213,6 @@ st.plotly_chart(fig_nr, use_container_width=True)
 st.markdown("### 🌀 Velocidade dos Fans")
 fig_fan = px.line(df, x='timestamp', y=['fan_rad_avg', 'fan_chs_avg'],
                   labels={'value': 'Fan %', 'timestamp': 'Horário'},
-                  title='Velocidade Média dos Fans')
+                  title='Velocidade Média dos Fans', render_mode='webgl')
 fig_fan.update_layout(paper_bgcolor='white', plot_bgcolor='white')
 st.plotly_chart(fig_fan, use_container_width=True)
@@ -2,22 +2,35 @@
 
 import os
 import time
-import csv
 import logging
 import smtplib # Not directly used, can be removed if 'mail' command is preferred.
-import numpy as np
 from datetime import datetime
 from liquidctl import find_liquidctl_devices
 import subprocess
 import argparse
+import atexit
 import glob
 import re # Added for more robust NVMe temperature parsing
-import pickle # Added to save and load the Q-table
+import struct
+import fcntl
+import ctypes
+import pickle # Only used to import a legacy dict-based Q-table
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit
+except ImportError: # numba is optional; the kernels then run as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # --- Configuration Constants ---
 LOG_FILE = '/var/log/fan_monitor_qlearning.log'
 DATA_FILE = '/var/log/fan_monitor_data.csv'
-Q_TABLE_FILE = '/var/lib/fan_monitor_q_table.pkl' # File to save/load the Q-table
+DATA_PARQUET_DIR = '/var/log/fan_monitor_data.parquet' # Parquet dataset directory, used with --parquet
+Q_TABLE_FILE = '/var/lib/fan_monitor_q_table.npy' # File to save/load the Q-table
+LEGACY_Q_TABLE_FILE = '/var/lib/fan_monitor_q_table.pkl' # Pickled dict Q-table from older versions
 
 # Q-learning and control parameters
 ALPHA = 0.05
@@ -33,14 +46,30 @@ CHS_FAN_MAX_SPEED = 100
 FAN_SPEED_ADJUSTMENT_STEP = 5 # Fan speed adjustment step
 TEMP_HISTORY_LENGTH = 6 # Temperature history length for averaging
 BUCKET_STEP = 2 # Step for temperature discretization (bucketing)
+Q_STATE_BUCKETS = 64 # Buckets per temperature axis (0-127°C with BUCKET_STEP = 2)
+DATA_FLUSH_ROWS = 6 # Flush the data file every N rows (one minute)
+Q_SAVE_INTERVAL = 60 # Save the Q-table every N ticks (ten minutes)
+PARQUET_FLUSH_ROWS = 60 # Rows per Parquet part file (ten minutes)
+
+# Fan speeds reachable by the heuristic, and their index along the Q-table action axes
+RAD_SPEED_IDX = {speed: i for i, speed in enumerate(range(RAD_FAN_MIN_SPEED, RAD_FAN_MAX_SPEED + 1, FAN_SPEED_ADJUSTMENT_STEP))}
+CHS_SPEED_IDX = {speed: i for i, speed in enumerate(range(CHS_FAN_MIN_SPEED, CHS_FAN_MAX_SPEED + 1, FAN_SPEED_ADJUSTMENT_STEP))}
+Q_SHAPE = (Q_STATE_BUCKETS, Q_STATE_BUCKETS, len(RAD_SPEED_IDX), len(CHS_SPEED_IDX))
 
 # Critical temperature limits for override
 CRITICAL_RAD_TEMP = 60
 CRITICAL_NVME_TEMP = 75 
 
+# Flexible regex to capture the NVMe temperature from 'nvme smart-log' output
+# Looks for "temperature", then an optional ':', spaces, the number, and an optional unit ('C' or '°C')
+# Only blanks are allowed between the label and the number so a match never spans lines.
+# The `(?:...)` creates a non-capturing group.
+NVME_TEMP_RE = re.compile(r"(?:temperature|temp|current temp|composite temp|sensor \d+ temp)[ \t:]*(\d+\.?\d*)[ \t]*(?:°C|C)?", re.IGNORECASE | re.MULTILINE)
+
 # --- Argument Parsing and Logging Setup ---
 parser = argparse.ArgumentParser(description="Fan monitor with Q-learning control.")
 parser.add_argument("--debug", action="store_true", help="Enables debug logging.")
+parser.add_argument("--parquet", action="store_true", help="Logs data rows to a Parquet dataset instead of the CSV file (requires pyarrow).")
 args = parser.parse_args()
 
 logging.basicConfig(
@@ -64,135 +93,285 @@ def notify_root(subject, message):
     except Exception as e:
         logging.error(f"Unexpected error when trying to send email: {e}")
 
-def bucket(temp):
-    """Divides temperature into 'buckets' for state discretization."""
-    return int(temp // BUCKET_STEP)
+@njit(cache=True)
+def compute_reward(temp_rad, temp_nvme, fan_rad, fan_chs, rad_target, nvme_target, hyst, noise_factor):
+    """Penalizes temperature deviation outside the hysteresis band and fan noise."""
+    rad_error = abs(temp_rad - rad_target)
+    nvme_error = abs(temp_nvme - nvme_target)
+
+    reward = 0.0
+    if rad_error > hyst or nvme_error > hyst:
+        reward = -(rad_error + nvme_error) # Penalize temperature deviation
+    reward -= noise_factor * (fan_rad + fan_chs) / 200.0 # Penalize noise (higher speed = more noise)
+    return reward
+
+@njit(cache=True)
+def q_update(q_val, reward, alpha):
+    """Simplified Q-learning update formula: Q(s,a) = Q(s,a) + alpha * (reward - Q(s,a))"""
+    return q_val + alpha * (reward - q_val)
+
+def count_q_states(q_table):
+    """Number of states with at least one non-zero action value."""
+    return int(np.count_nonzero(q_table.any(axis=(2, 3))))
+
+def load_legacy_q_table(filename):
+    """Converts a pickled {state: {action: value}} Q-table into the dense array layout."""
+    with open(filename, 'rb') as f:
+        legacy = pickle.load(f)
+    q_table = np.zeros(Q_SHAPE, dtype=np.float32)
+    for (s0, s1), actions in legacy.items():
+        for (rad, chs), value in actions.items():
+            if 0 <= s0 < Q_STATE_BUCKETS and 0 <= s1 < Q_STATE_BUCKETS and rad in RAD_SPEED_IDX and chs in CHS_SPEED_IDX:
+                q_table[s0, s1, RAD_SPEED_IDX[rad], CHS_SPEED_IDX[chs]] = value
+    return q_table
 
 def load_q_table(filename):
-    """Loads the Q-table from a pickle file."""
-    if os.path.exists(filename):
-        try:
-            with open(filename, 'rb') as f:
-                q_table = pickle.load(f)
-            logging.info(f"Q-table loaded from '{filename}'. Size: {len(q_table)} states.")
-            return q_table
-        except Exception as e:
-            logging.error(f"Error loading Q-table from '{filename}': {e}. Starting with empty table.")
-            return {}
-    else:
-        logging.info(f"Q-table file '{filename}' not found. Starting with empty table.")
-        return {}
+    """Loads the Q-table from a .npy file, importing the legacy pickle if that is all there is."""
+    try:
+        if os.path.exists(filename):
+            # Memory-mapped read/write: no in-memory copy of the table at startup
+            q_table = np.load(filename, mmap_mode='r+')
+            if q_table.shape != Q_SHAPE:
+                logging.error(f"Q-table in '{filename}' has shape {q_table.shape}, expected {Q_SHAPE}. Starting with empty table.")
+                return np.zeros(Q_SHAPE, dtype=np.float32)
+            q_table = q_table.astype(np.float32, copy=False)
+        elif os.path.exists(LEGACY_Q_TABLE_FILE):
+            q_table = load_legacy_q_table(LEGACY_Q_TABLE_FILE)
+            filename = LEGACY_Q_TABLE_FILE
+        else:
+            logging.info(f"Q-table file '{filename}' not found. Starting with empty table.")
+            return np.zeros(Q_SHAPE, dtype=np.float32)
+        logging.info(f"Q-table loaded from '{filename}'. Size: {count_q_states(q_table)} states.")
+        return q_table
+    except Exception as e:
+        logging.error(f"Error loading Q-table from '{filename}': {e}. Starting with empty table.")
+        return np.zeros(Q_SHAPE, dtype=np.float32)
 
 def save_q_table(q_table, filename):
-    """Saves the Q-table to a pickle file."""
+    """Saves the Q-table to a .npy file, atomically replacing the previous one."""
     try:
         # Ensures the directory exists
         os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, 'wb') as f:
-            pickle.dump(q_table, f)
-        logging.info(f"Q-table saved to '{filename}'. Size: {len(q_table)} states.")
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, q_table)
+        os.replace(tmp_file, filename)
+        logging.info(f"Q-table saved to '{filename}'. Size: {count_q_states(q_table)} states.")
     except Exception as e:
         logging.error(f"Error saving Q-table to '{filename}': {e}")
 
+def release_device(device):
+    """Disconnects a liquidctl device, ignoring errors from an already-broken handle."""
+    try:
+        device.disconnect()
+    except Exception:
+        pass
+
 def get_liquidctl_temps(device):
     """
-    Connects to the Liquidctl device and extracts radiator temperatures.
+    Extracts radiator temperatures from an already-connected Liquidctl device.
     Returns (temp_rad_in, temp_rad_out) or (None, None) on error.
+    OSError is re-raised so the caller can drop the handle and reconnect.
     """
     temp_rad_in, temp_rad_out = None, None
     try:
-        with device.connect():
-            status = device.get_status()
-            logging.debug(f"Device status for {device.description}: {status}")
-            for key, value, unit in status:
-                logging.debug(f"Parsing: key='{key}', value='{value}', unit='{unit}'") # Extra debug
-                
-                # If key contains "Temperature" AND unit is "°C"
-                if "Temperature" in key and unit == '°C':
-                    try:
-                        # 'value' is already the numeric float, no regex needed
-                        temp_val = float(value) 
-                        if "Temperature 0" in key:
-                            temp_rad_out = temp_val # Typically Radiator Out
-                            logging.debug(f"Detected Temperature 0: {temp_rad_out}°C")
-                        elif "Temperature 1" in key:
-                            temp_rad_in = temp_val # Typically Radiator In
-                            logging.debug(f"Detected Temperature 1: {temp_rad_in}°C")
-                    except ValueError as e:
-                        logging.warning(f"Failed to convert temperature value '{value}' to float: {e}")
-            
-            logging.info(f"Radiator IN: {temp_rad_in}°C, OUT: {temp_rad_out}°C")
-            return temp_rad_in, temp_rad_out
+        status = device.get_status()
+        logging.debug("Device status for %s: %s", device.description, status)
+        for key, value, unit in status:
+            logging.debug("Parsing: key='%s', value='%s', unit='%s'", key, value, unit) # Extra debug, formatted only at DEBUG level
+
+            # Matched on the key alone; the unit string's encoding varies between liquidctl versions
+            try:
+                # 'value' is already the numeric float, no regex needed
+                if key == "Temperature 0":
+                    temp_rad_out = float(value) # Typically Radiator Out
+                    logging.debug("Detected Temperature 0: %s°C", temp_rad_out)
+                elif key == "Temperature 1":
+                    temp_rad_in = float(value) # Typically Radiator In
+                    logging.debug("Detected Temperature 1: %s°C", temp_rad_in)
+                else:
+                    continue
+            except ValueError as e:
+                logging.warning(f"Failed to convert temperature value '{value}' to float: {e}")
+                continue
+
+            if temp_rad_in is not None and temp_rad_out is not None:
+                break # Both sensors read, skip the remaining status entries
+
+        logging.info(f"Radiator IN: {temp_rad_in}°C, OUT: {temp_rad_out}°C")
+        return temp_rad_in, temp_rad_out
+    except OSError:
+        raise
     except Exception as e:
         logging.error(f"Error accessing liquidctl device ({device.description}): {e}")
         return None, None
 
+# NVMe admin passthrough (linux/nvme_ioctl.h): struct nvme_admin_cmd and NVME_IOCTL_ADMIN_CMD
+_NVME_ADMIN_CMD = struct.Struct('<BBHIIIQQII6III')
+NVME_IOCTL_ADMIN_CMD = (3 << 30) | (_NVME_ADMIN_CMD.size << 16) | (ord('N') << 8) | 0x41 # _IOWR('N', 0x41, ...)
+NVME_SMART_LOG_LEN = 512
+_nvme_ioctl_ok = True # Cleared once the ioctl is refused (needs CAP_SYS_ADMIN)
+
+def read_nvme_smart_temp(dev):
+    """
+    Reads the composite temperature of an NVMe device with a Get Log Page (SMART, 0x02) admin ioctl.
+    Returns the temperature in °C. Raises OSError if the ioctl is not available.
+    """
+    buf = ctypes.create_string_buffer(NVME_SMART_LOG_LEN)
+    numd = NVME_SMART_LOG_LEN // 4 - 1 # Number of dwords, zero-based
+    cmd = bytearray(_NVME_ADMIN_CMD.pack(
+        0x02, 0, 0, 0xFFFFFFFF, 0, 0,     # opcode Get Log Page, flags, rsvd1, nsid (controller-wide), cdw2, cdw3
+        0, ctypes.addressof(buf), 0,      # metadata, addr, metadata_len
+        NVME_SMART_LOG_LEN,               # data_len
+        (numd << 16) | 0x02, 0, 0, 0, 0, 0, # cdw10 (NUMDL | LID), cdw11-15
+        0, 0                              # timeout_ms, result
+    ))
+    fd = os.open(dev, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, NVME_IOCTL_ADMIN_CMD, cmd)
+    finally:
+        os.close(fd)
+    kelvin = int.from_bytes(buf.raw[1:3], 'little') # Composite temperature, bytes 1-2
+    return kelvin - 273.15 if kelvin else 0.0
+
+def _read_one_nvme(dev):
+    """
+    Reads the temperature of a single NVMe device, via the SMART log ioctl when permitted
+    and 'nvme smart-log' otherwise.
+    Returns the temperature or 0.0 if it could not be read.
+    """
+    global _nvme_ioctl_ok
+    if _nvme_ioctl_ok:
+        try:
+            return read_nvme_smart_temp(dev)
+        except PermissionError as e:
+            logging.warning(f"NVMe admin ioctl not permitted on {dev}: {e}. Using 'nvme smart-log' from now on.")
+            _nvme_ioctl_ok = False
+        except OSError as e:
+            logging.debug("NVMe admin ioctl failed on %s: %s. Falling back to 'nvme smart-log'.", dev, e)
+
+    try:
+        result = subprocess.run(
+            ['nvme', 'smart-log', dev],
+            capture_output=True,
+            text=True,
+            check=True, # Raises CalledProcessError if command fails
+            timeout=5
+        )
+        # Scan the whole output in one pass instead of line by line
+        for match in NVME_TEMP_RE.finditer(result.stdout):
+            nvme_temp = float(match.group(1))
+            if nvme_temp > 0: # Ignore invalid readings (e.g., 0.0)
+                logging.debug("NVMe temperature '%s°C' found on '%s' in line: '%s'", nvme_temp, dev, match.group(0).strip())
+                return nvme_temp # Found temperature, can stop searching for this NVMe
+        if "temperature" in result.stdout.lower(): # A fallback for debugging
+             logging.warning(f"NVMe temperature not found in output of {dev} despite containing the word 'temperature'. Content: \n{result.stdout}")
+        else:
+            logging.warning(f"NVMe temperature not found in output of {dev}.")
+    except FileNotFoundError:
+        logging.warning(f"'nvme' command not found. Ensure 'nvme-cli' package is installed.")
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Error executing 'nvme smart-log {dev}': {e.stderr.strip()}")
+    except subprocess.TimeoutExpired:
+        logging.warning(f"Timeout exceeded when reading NVMe from {dev}.")
+    except Exception as e:
+        logging.warning(f"Unexpected error when reading NVMe from {dev}: {e}")
+    return 0.0
+
 def get_nvme_temp():
     """
     Reads the maximum temperature from all detected NVMe devices.
+    The composite temperature is read from the kernel's hwmon node (millidegrees C);
+    kernels without it fall back to per-device reads (SMART log ioctl or 'nvme smart-log'),
+    run in parallel so a tick waits for the slowest device only.
     Returns the maximum temperature or 0.0 if none is found.
     """
+    hwmon_paths = glob.glob('/sys/class/nvme/nvme*/hwmon*/temp1_input')
+    if hwmon_paths:
+        try:
+            nvme_temps = []
+            for path in hwmon_paths:
+                with open(path) as f:
+                    nvme_temps.append(int(f.read()) / 1000.0)
+            logging.debug("NVMe temperatures from hwmon: %s", nvme_temps)
+            return max(nvme_temps)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to read NVMe hwmon temperature: {e}. Falling back to 'nvme smart-log'.")
+
     nvme_devices = glob.glob('/dev/nvme*n1')
     logging.info(f"Detected NVMe devices: {[os.path.basename(dev) for dev in nvme_devices]}")
-    nvme_temps = []
-    
-    # Flexible regex to capture temperature
-    # Looks for "temperature", followed by anything (non-greedy),
-    # then an optional ':', spaces, the number, and an optional unit ('C' or '°C')
-    # The `(?:...)` creates a non-capturing group.
-    temp_pattern = re.compile(r"(?:temperature|temp|current temp|composite temp|sensor \d+ temp)[\s:]*(\d+\.?\d*)\s*(?:°C|C)?", re.IGNORECASE)
-
-    for dev in nvme_devices:
-        try:
-            result = subprocess.run(
-                ['nvme', 'smart-log', dev],
-                capture_output=True,
-                text=True,
-                check=True, # Raises CalledProcessError if command fails
-                timeout=5
-            )
-            # Iterate line by line to find the temperature
-            for line in result.stdout.splitlines():
-                match = temp_pattern.search(line)
-                if match:
-                    nvme_temp = float(match.group(1))
-                    if nvme_temp > 0: # Ignore invalid readings (e.g., 0.0)
-                        nvme_temps.append(nvme_temp)
-                        logging.debug(f"NVMe temperature '{nvme_temp}°C' found on '{dev}' in line: '{line.strip()}'")
-                        break # Found temperature, can stop searching for this NVMe
-            if not nvme_temps and "temperature" in result.stdout.lower(): # A fallback for debugging
-                 logging.warning(f"NVMe temperature not found in output of {dev} despite containing the word 'temperature'. Content: \n{result.stdout}")
-            elif not nvme_temps:
-                logging.warning(f"NVMe temperature not found in output of {dev}.")
-        except FileNotFoundError:
-            logging.warning(f"'nvme' command not found. Ensure 'nvme-cli' package is installed.")
-        except subprocess.CalledProcessError as e:
-            logging.warning(f"Error executing 'nvme smart-log {dev}': {e.stderr.strip()}")
-        except subprocess.TimeoutExpired:
-            logging.warning(f"Timeout exceeded when reading NVMe from {dev}.")
-        except Exception as e:
-            logging.warning(f"Unexpected error when reading NVMe from {dev}: {e}")
+    if not nvme_devices:
+        return 0.0
+
+    with ThreadPoolExecutor(max_workers=len(nvme_devices)) as ex:
+        nvme_temps = list(ex.map(_read_one_nvme, nvme_devices))
 
-    return max(nvme_temps) if nvme_temps else 0.0
+    return max(nvme_temps)
+
+def write_parquet_part(rows):
+    """
+    Writes buffered data rows as one Parquet part file in DATA_PARQUET_DIR.
+    The file is written under a hidden name and renamed, so readers never see a partial file.
+    """
+    if not rows:
+        return
+    try:
+        columns = list(zip(*rows))
+        table = pa.Table.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(columns, PARQUET_SCHEMA)],
+            schema=PARQUET_SCHEMA
+        )
+        os.makedirs(DATA_PARQUET_DIR, exist_ok=True)
+        name = f"part-{rows[0][0]:%Y%m%d-%H%M%S}.parquet"
+        tmp_path = os.path.join(DATA_PARQUET_DIR, '.' + name) # Dot files are skipped by Parquet dataset readers
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(DATA_PARQUET_DIR, name))
+        logging.debug("Wrote %d rows to Parquet part '%s'", len(rows), name)
+    except Exception as e:
+        logging.error(f"Failed to write Parquet data to '{DATA_PARQUET_DIR}': {e}")
 
 # --- Initialization ---
-# Checks and creates the data CSV file if it doesn't exist
-if not os.path.exists(DATA_FILE):
-    logging.info(f"Data file '{DATA_FILE}' not found, creating new one.")
-    # Ensures the directory exists
-    os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
-    with open(DATA_FILE, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['timestamp', 'temp_rad', 'temp_nvme', 'fan_rad', 'fan_chs', 'noise_est', 'reward'])
-
-# Load the Q-table at script start
+use_parquet = args.parquet
+if use_parquet:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        PARQUET_SCHEMA = pa.schema([
+            ('timestamp', pa.timestamp('s')), ('temp_rad', pa.float32()), ('temp_nvme', pa.float32()),
+            ('fan_rad', pa.float32()), ('fan_chs', pa.float32()), ('noise_est', pa.float32()), ('reward', pa.float32()),
+        ])
+    except ImportError as e:
+        logging.error(f"--parquet requested but pyarrow is not available ({e}). Logging to CSV instead.")
+        use_parquet = False
+
+parquet_rows = [] # Rows waiting for the next Parquet part file
+data_rows = 0
+
+if not use_parquet:
+    # Checks and creates the data CSV file if it doesn't exist
+    if not os.path.exists(DATA_FILE):
+        logging.info(f"Data file '{DATA_FILE}' not found, creating new one.")
+        # Ensures the directory exists
+        os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
+        with open(DATA_FILE, 'w') as f:
+            f.write("timestamp,temp_rad,temp_nvme,fan_rad,fan_chs,noise_est,reward\n")
+
+    # Keeps the data file open for the whole run; rows are buffered and flushed periodically
+    DATA_FH = open(DATA_FILE, 'a', buffering=1 << 16)
+    atexit.register(DATA_FH.close)
+
+# Load the Q-table at script start: Q[rad_bucket, nvme_bucket, rad_speed_idx, chs_speed_idx]
 Q = load_q_table(Q_TABLE_FILE)
 
 # Initial state variables
-temp_rad_hist = []
-temp_nvme_hist = []
+temp_rad_hist = deque(maxlen=TEMP_HISTORY_LENGTH)
+temp_nvme_hist = deque(maxlen=TEMP_HISTORY_LENGTH)
+rad_sum = 0.0 # Running sums of the histories, kept in step with the deques
+nvme_sum = 0.0
 fan_rad_speed = 50
 fan_chs_speed = 50
+target_device = None # Connected Commander Core XT; None until found and connected
+last_rad = last_chs = -1 # Speeds last written to the device; -1 forces the first write
 
 notify_root("Fan Monitor Started", "Q-learning fan monitor is now active.")
 
@@ -202,64 +381,81 @@ last_notification_time = 0.0 # Initialize to a time in the distant past
 # --- Main Loop ---
 try:
     while True:
-        timestamp = datetime.now().isoformat()
-
         # 1. Liquidctl Device Discovery
-        devices = list(find_liquidctl_devices())
-        if not devices:
-            logging.warning("No liquidctl devices found. Retrying in 10s.")
-            time.sleep(10)
-            continue
+        # The device is found and connected once; the handle stays open until an I/O error
+        if target_device is None:
+            devices = list(find_liquidctl_devices())
+            if not devices:
+                logging.warning("No liquidctl devices found. Retrying in 10s.")
+                time.sleep(10)
+                continue
+
+            for dev in devices:
+                if "Commander Core XT" in dev.description:
+                    target_device = dev
+                    break
+
+            if not target_device:
+                logging.error("Commander Core XT not found among devices. Retrying in 10s.")
+                time.sleep(10)
+                continue
+
+            try:
+                target_device.connect()
+            except Exception as e:
+                logging.error(f"Error connecting to liquidctl device ({target_device.description}): {e}. Retrying in 10s.")
+                target_device = None
+                time.sleep(10)
+                continue
 
-        target_device = None
-        for dev in devices:
-            if "Commander Core XT" in dev.description:
-                target_device = dev
-                break
-
-        if not target_device:
-            logging.error("Commander Core XT not found among devices. Retrying in 10s.")
+        # 2. Temperature Readings
+        try:
+            temp_rad_in, temp_rad_out = get_liquidctl_temps(target_device)
+        except OSError as e:
+            logging.error(f"Lost connection to liquidctl device ({target_device.description}): {e}. Reconnecting in 10s.")
+            release_device(target_device)
+            target_device = None
+            last_rad = last_chs = -1
             time.sleep(10)
             continue
-
-        # 2. Temperature Readings
-        temp_rad_in, temp_rad_out = get_liquidctl_temps(target_device)
         if temp_rad_in is None: # If radiator reading failed
             time.sleep(10)
             continue
 
         temp_nvme = get_nvme_temp()
 
+        # Sampled once per completed reading and shared by the alert, the log row and the throttle
+        now_epoch = time.time()
+        now = datetime.fromtimestamp(now_epoch)
+        timestamp = now.isoformat(timespec='seconds')
+
         # 3. Update Temperature History
+        # The deques drop their oldest item at TEMP_HISTORY_LENGTH, so subtract it from the sums first
+        if len(temp_rad_hist) == TEMP_HISTORY_LENGTH:
+            rad_sum -= temp_rad_hist[0]
+            nvme_sum -= temp_nvme_hist[0]
         temp_rad_hist.append(temp_rad_in)
         temp_nvme_hist.append(temp_nvme)
-        # Keep history at TEMP_HISTORY_LENGTH items
-        if len(temp_rad_hist) > TEMP_HISTORY_LENGTH:
-            temp_rad_hist.pop(0)
-            temp_nvme_hist.pop(0)
+        rad_sum += temp_rad_in
+        nvme_sum += temp_nvme
 
-        temp_rad_avg = np.mean(temp_rad_hist)
-        temp_nvme_avg = np.mean(temp_nvme_hist)
+        temp_rad_avg = rad_sum / len(temp_rad_hist)
+        temp_nvme_avg = nvme_sum / len(temp_nvme_hist)
 
         # 4. Q-Learning Logic
-        state = (bucket(temp_rad_avg), bucket(temp_nvme_avg))
-        action = (fan_rad_speed, fan_chs_speed)
-
-        rad_error = abs(temp_rad_avg - RAD_TARGET_TEMP)
-        nvme_error = abs(temp_nvme_avg - NVME_TARGET_TEMP)
+        # State: temperature buckets of BUCKET_STEP °C, clamped to the Q-table range
+        sr = min(max(int(temp_rad_avg) // BUCKET_STEP, 0), Q_STATE_BUCKETS - 1)
+        sn = min(max(int(temp_nvme_avg) // BUCKET_STEP, 0), Q_STATE_BUCKETS - 1)
+        ar = RAD_SPEED_IDX[fan_rad_speed]
+        ac = CHS_SPEED_IDX[fan_chs_speed]
 
-        reward = 0
-        if rad_error > TEMP_HYSTERESIS or nvme_error > TEMP_HYSTERESIS:
-            reward = -(rad_error + nvme_error) # Penalize temperature deviation
-        reward -= NOISE_PENALTY_FACTOR * (fan_rad_speed + fan_chs_speed) / 200.0 # Penalize noise (higher speed = more noise)
+        # Scalar arguments keep the compiled kernels on a single specialization
+        reward = compute_reward(float(temp_rad_avg), float(temp_nvme_avg),
+                                float(fan_rad_speed), float(fan_chs_speed),
+                                RAD_TARGET_TEMP, NVME_TARGET_TEMP, TEMP_HYSTERESIS, NOISE_PENALTY_FACTOR)
 
         # Q-value update
-        if state not in Q:
-            Q[state] = {}
-        if action not in Q[state]:
-            Q[state][action] = 0.0
-        # Simplified Q-learning update formula: Q(s,a) = Q(s,a) + alpha * (reward - Q(s,a))
-        Q[state][action] += ALPHA * (reward - Q[state][action])
+        Q[sr, sn, ar, ac] = q_update(float(Q[sr, sn, ar, ac]), reward, ALPHA)
 
         # 5. Fan Speed Adjustment (Based on Simple Heuristic)
         # This adjustment is a rule-based control, not directly from the Q-table
@@ -282,7 +478,7 @@ try:
             #notify_root("🔥 Critical Temperature", f"Radiator or NVMe overheat detected at {timestamp}! Radiator: {temp_rad_in}°C, NVMe: {temp_nvme}°C.")
             
             # --- Notification Throttling Logic ---
-            current_time = time.time()
+            current_time = now_epoch
             # Check if 60 seconds have passed since the last notification
             if current_time - last_notification_time > 60:
                 notify_root("🔥 Critical Temperature", f"Radiator or NVMe overheat detected at {timestamp}! Radiator: {temp_rad_in}°C, NVMe: {temp_nvme}°C.")
@@ -292,18 +488,29 @@ try:
 
 
         # 7. Apply Fan Speeds
+        # Each write is a separate USB transaction, so unchanged speeds are not re-sent
         try:
-            with target_device.connect():
-                # Assuming fan1, fan2, fan3 are for the radiator and fan4, fan5, fan6 are for the chassis
-                target_device.set_fixed_speed("fan1", fan_rad_speed)
-                target_device.set_fixed_speed("fan2", fan_rad_speed)
-                target_device.set_fixed_speed("fan3", fan_rad_speed)
-                target_device.set_fixed_speed("fan4", fan_chs_speed)
-                target_device.set_fixed_speed("fan5", fan_chs_speed)
-                target_device.set_fixed_speed("fan6", fan_chs_speed)
-                logging.info(f"Fan speeds adjusted: Radiator {fan_rad_speed}%, Chassis {fan_chs_speed}%.")
+            # Assuming fan1, fan2, fan3 are for the radiator and fan4, fan5, fan6 are for the chassis
+            if fan_rad_speed != last_rad:
+                for channel in ("fan1", "fan2", "fan3"):
+                    target_device.set_fixed_speed(channel, fan_rad_speed)
+                last_rad = fan_rad_speed
+                logging.info(f"Radiator fan speed adjusted: {fan_rad_speed}%.")
+            if fan_chs_speed != last_chs:
+                for channel in ("fan4", "fan5", "fan6"):
+                    target_device.set_fixed_speed(channel, fan_chs_speed)
+                last_chs = fan_chs_speed
+                logging.info(f"Chassis fan speed adjusted: {fan_chs_speed}%.")
+        except OSError as e:
+            logging.error(f"Lost connection to liquidctl device while setting fan speeds: {e}. Reconnecting in 10s.")
+            release_device(target_device)
+            target_device = None
+            last_rad = last_chs = -1
+            time.sleep(10)
+            continue
         except Exception as e:
             logging.error(f"Failed to set fan speeds: {e}. Retrying in 10s.")
+            last_rad = last_chs = -1 # State of a partial write is unknown
             time.sleep(10) # Longer pause in case of critical fan control error
             continue
 
@@ -315,14 +522,27 @@ try:
         # No longer prints to console by default, logging handles it.
         # print(log_msg) # Uncomment if you want console output
 
-        with open(DATA_FILE, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                timestamp, temp_rad_avg, temp_nvme_avg,
-                fan_rad_speed, fan_chs_speed,
+        data_rows += 1
+        if use_parquet:
+            parquet_rows.append((
+                now, temp_rad_avg, temp_nvme_avg, fan_rad_speed, fan_chs_speed,
                 (fan_rad_speed + fan_chs_speed) / 2, # Noise estimate
                 reward
-            ])
+            ))
+            if len(parquet_rows) >= PARQUET_FLUSH_ROWS:
+                write_parquet_part(parquet_rows)
+                parquet_rows = []
+        else:
+            DATA_FH.write(
+                f"{timestamp},{temp_rad_avg:.2f},{temp_nvme_avg:.2f},"
+                f"{fan_rad_speed},{fan_chs_speed},"
+                f"{(fan_rad_speed + fan_chs_speed) / 2}," # Noise estimate
+                f"{reward:.2f}\n"
+            )
+            if data_rows % DATA_FLUSH_ROWS == 0:
+                DATA_FH.flush() # Keeps the dashboard at most a minute behind
+        if data_rows % Q_SAVE_INTERVAL == 0:
+            save_q_table(Q, Q_TABLE_FILE) # Bounds what a crash or power loss can lose
 
         time.sleep(10) # Interval between readings
 
@@ -333,6 +553,10 @@ except Exception as e:
     notify_root("Fan Monitor Crashed", f"Unexpected error: {e}")
     logging.exception("Unhandled exception in main loop.")
 finally:
+    if target_device is not None:
+        release_device(target_device)
+    if use_parquet:
+        write_parquet_part(parquet_rows)
     # Ensures the Q-table is saved under any exit circumstance
     save_q_table(Q, Q_TABLE_FILE)
     logging.info("Script finished.")
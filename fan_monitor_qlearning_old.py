@@ -3,12 +3,12 @@ import time
 import csv
 import logging
 import smtplib
-import numpy as np
 from datetime import datetime
 from liquidctl import find_liquidctl_devices
 import subprocess
 import argparse
 import glob
+import re
 
 LOG_FILE = '/var/log/fan_monitor_qlearning.log'
 DATA_FILE = '/var/log/fan_monitor_data.csv'
@@ -22,6 +22,8 @@ TEMP_HYSTERESIS = 3.0
 rad_min, rad_max = 30, 100
 chs_min, chs_max = 30, 100
 
+TEMP_RE = re.compile(r'([-+]?\d+(?:\.\d+)?)')
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--debug", action="store_true", help="Enable debug logging")
 args = parser.parse_args()
@@ -39,14 +41,30 @@ if not os.path.exists(DATA_FILE):
         writer = csv.writer(f)
         writer.writerow(['timestamp', 'temp_rad', 'temp_nvme', 'fan_rad', 'fan_chs', 'noise_est', 'reward'])
 
+# Data file kept open for the whole run; flushed every 6 rows (one minute)
+data_fh = open(DATA_FILE, 'a', newline='', buffering=65536)
+data_writer = csv.writer(data_fh)
+data_rows = 0
+
 Q = {}
 def bucket(temp, step=2):
     return int(temp // step)
 
+def step_update(avg, target, hyst, cur, lo, hi):
+    # +5 above the hysteresis band, -5 below it, unchanged inside; clamped to [lo, hi]
+    return min(max(cur + 5 * ((avg > target + hyst) - (avg < target - hyst)), lo), hi)
+
 temp_rad_hist = []
 temp_nvme_hist = []
 fan_rad_speed = 50
 fan_chs_speed = 50
+target_device = None  # Kept connected across iterations; cleared after an I/O error
+
+def release_device(device):
+    try:
+        device.disconnect()
+    except Exception:
+        pass
 
 notify_root("Fan Monitor Started", "Q-learning fan monitor is now active.")
 
@@ -54,46 +72,56 @@ try:
     while True:
         timestamp = datetime.now().isoformat()
 
-        devices = list(find_liquidctl_devices())
-        logging.info(f"Found {len(devices)} liquidctl devices.")
-        if not devices:
-            logging.warning("No liquidctl devices found.")
-            time.sleep(10)
-            continue
+        if target_device is None:
+            devices = list(find_liquidctl_devices())
+            logging.info(f"Found {len(devices)} liquidctl devices.")
+            if not devices:
+                logging.warning("No liquidctl devices found.")
+                time.sleep(10)
+                continue
 
-        temp_rad_in = None
-        temp_rad_out = None
+            for dev in devices:
+                if "Commander Core XT" in dev.description:
+                    target_device = dev
+                    break
 
-        target_device = None
-        for dev in devices:
-            if "Commander Core XT" in dev.description:
-                target_device = dev
-                break
+            if not target_device:
+                logging.error("Commander Core XT not found among devices.")
+                time.sleep(10)
+                continue
 
-        if not target_device:
-            logging.error("Commander Core XT not found among devices.")
-            time.sleep(10)
-            continue
+            try:
+                target_device.connect()
+                logging.info(f"Connected to device: {target_device.description}")
+            except Exception as e:
+                logging.error(f"Error connecting to liquidctl device: {e}")
+                target_device = None
+                time.sleep(10)
+                continue
+
+        temp_rad_in = None
+        temp_rad_out = None
 
         try:
-            with target_device.connect():
-                status = target_device.get_status()
-                logging.info(f"Connected to device: {target_device.description}")
-                for key, value, unit in status:
-                    logging.debug(f"{key}: {value} {unit}")
-                    if "Temperature" in key and "0" in key:
-                        try:
-                            temp_rad_out = float(str(value).replace("°C", "").strip())
-                        except Exception as e:
-                            logging.warning(f"Failed to parse temp_rad_out: {value} - {e}")
-                    elif "Temperature" in key and "1" in key:
-                        try:
-                            temp_rad_in = float(str(value).replace("°C", "").strip())
-                        except Exception as e:
-                            logging.warning(f"Failed to parse temp_rad_in: {value} - {e}")
-                logging.info(f"Radiator IN: {temp_rad_in}°C, OUT: {temp_rad_out}°C")
+            status = target_device.get_status()
+            logging.debug("%s status: %s", target_device.description, status)
+            # Both radiator sensors come from one pass over the status, looked up by exact key
+            sensors = {key: str(value) for key, value, _ in status if key.startswith("Temperature")}
+            m = TEMP_RE.search(sensors.get("Temperature 0", ""))
+            if m:
+                temp_rad_out = float(m.group(1))
+            else:
+                logging.warning(f"Failed to parse temp_rad_out: {sensors.get('Temperature 0')}")
+            m = TEMP_RE.search(sensors.get("Temperature 1", ""))
+            if m:
+                temp_rad_in = float(m.group(1))
+            else:
+                logging.warning(f"Failed to parse temp_rad_in: {sensors.get('Temperature 1')}")
+            logging.info(f"Radiator IN: {temp_rad_in}°C, OUT: {temp_rad_out}°C")
         except Exception as e:
             logging.error(f"Error accessing liquidctl device: {e}")
+            release_device(target_device)
+            target_device = None
             time.sleep(10)
             continue
 
@@ -105,10 +133,10 @@ try:
                 result = subprocess.run(['nvme', 'smart-log', dev], capture_output=True, text=True)
                 for line in result.stdout.splitlines():
                     if "temperature" in line.lower() and "sensor" not in line.lower():
-                        parts = line.split(":")
-                        if len(parts) == 2:
-                            temp_str = parts[1].strip().split(" ")[0].replace("°C", "")
-                            nvme_temp = float(temp_str)
+                        _, sep, field = line.partition(":")
+                        m = TEMP_RE.search(field) if sep else None
+                        if m:
+                            nvme_temp = float(m.group(1))
                             if nvme_temp > 0:
                                 nvme_temps.append(nvme_temp)
             except Exception as e:
@@ -127,8 +155,8 @@ try:
             temp_rad_hist.pop(0)
             temp_nvme_hist.pop(0)
 
-        temp_rad_avg = np.mean(temp_rad_hist)
-        temp_nvme_avg = np.mean(temp_nvme_hist)
+        temp_rad_avg = sum(temp_rad_hist) / len(temp_rad_hist)
+        temp_nvme_avg = sum(temp_nvme_hist) / len(temp_nvme_hist)
         state = (bucket(temp_rad_avg), bucket(temp_nvme_avg))
         action = (fan_rad_speed, fan_chs_speed)
 
@@ -137,21 +165,14 @@ try:
         reward = 0 if rad_error < TEMP_HYSTERESIS and nvme_error < TEMP_HYSTERESIS else -(rad_error + nvme_error)
         reward -= noise_penalty * (fan_rad_speed + fan_chs_speed) / 200.0
 
-        if state not in Q:
-            Q[state] = {}
-        if action not in Q[state]:
-            Q[state][action] = 0.0
-        Q[state][action] += alpha * (reward - Q[state][action])
+        row = Q.get(state)
+        if row is None:
+            Q[state] = row = {}
+        q = row.get(action, 0.0)
+        row[action] = q + alpha * (reward - q)
 
-        if temp_rad_avg > rad_target + TEMP_HYSTERESIS:
-            fan_rad_speed = min(fan_rad_speed + 5, rad_max)
-        elif temp_rad_avg < rad_target - TEMP_HYSTERESIS:
-            fan_rad_speed = max(fan_rad_speed - 5, rad_min)
-
-        if temp_nvme_avg > nvme_target + TEMP_HYSTERESIS:
-            fan_chs_speed = min(fan_chs_speed + 5, chs_max)
-        elif temp_nvme_avg < nvme_target - TEMP_HYSTERESIS:
-            fan_chs_speed = max(fan_chs_speed - 5, chs_min)
+        fan_rad_speed = step_update(temp_rad_avg, rad_target, TEMP_HYSTERESIS, fan_rad_speed, rad_min, rad_max)
+        fan_chs_speed = step_update(temp_nvme_avg, nvme_target, TEMP_HYSTERESIS, fan_chs_speed, chs_min, chs_max)
 
         if temp_rad_in > 60 or temp_nvme > 75:
             fan_rad_speed = 100
@@ -159,16 +180,17 @@ try:
             notify_root("🔥 Critical Temperature", f"Radiator or NVMe overheat detected at {timestamp}!")
 
         try:
-            with target_device.connect():
-                target_device.set_fixed_speed("fan1", fan_rad_speed)
-                target_device.set_fixed_speed("fan2", fan_rad_speed)
-                target_device.set_fixed_speed("fan3", fan_rad_speed)
-                target_device.set_fixed_speed("fan4", fan_chs_speed)
-                target_device.set_fixed_speed("fan5", fan_chs_speed)
-                target_device.set_fixed_speed("fan6", fan_chs_speed)
+            target_device.set_fixed_speed("fan1", fan_rad_speed)
+            target_device.set_fixed_speed("fan2", fan_rad_speed)
+            target_device.set_fixed_speed("fan3", fan_rad_speed)
+            target_device.set_fixed_speed("fan4", fan_chs_speed)
+            target_device.set_fixed_speed("fan5", fan_chs_speed)
+            target_device.set_fixed_speed("fan6", fan_chs_speed)
 
         except Exception as e:
             logging.error(f"Failed to set fan speeds: {e}")
+            release_device(target_device)
+            target_device = None
             time.sleep(10)
             continue
 
@@ -176,9 +198,10 @@ try:
         logging.info(log_msg)
         print(log_msg)
 
-        with open(DATA_FILE, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([timestamp, temp_rad_avg, temp_nvme_avg, fan_rad_speed, fan_chs_speed, (fan_rad_speed+fan_chs_speed)/2, reward])
+        data_writer.writerow([timestamp, temp_rad_avg, temp_nvme_avg, fan_rad_speed, fan_chs_speed, (fan_rad_speed+fan_chs_speed)/2, reward])
+        data_rows += 1
+        if data_rows % 6 == 0:
+            data_fh.flush()
 
         time.sleep(10)
 
@@ -188,4 +211,9 @@ except KeyboardInterrupt:
 
 except Exception as e:
     notify_root("Fan Monitor Crashed", f"Unexpected error: {e}")
-    logging.exception("Unhandled exception")
\ No newline at end of file
+    logging.exception("Unhandled exception")
+
+finally:
+    if target_device is not None:
+        release_device(target_device)
+    data_fh.close()
\ No newline at end of file
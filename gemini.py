@@ -6,17 +6,30 @@ import json
 import subprocess
 import argparse
 import glob
-from datetime import datetime
+import re
+import queue
+import threading
 from typing import Dict, Tuple, List, Optional, Any
 
 import numpy as np
 from liquidctl import find_liquidctl_devices
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the kernel then runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 # --- Constants ---
 LOG_FILE = '/var/log/fan_monitor_qlearning.log'
 DATA_FILE = '/var/log/fan_monitor_data.csv'
-Q_TABLE_FILE = '/var/log/q_table.json'
+Q_TABLE_FILE = '/var/log/q_table.npz'
+LEGACY_Q_TABLE_FILE = '/var/log/q_table.json'  # {"s0_s1": {"rad_chs": q}} table from older versions
 CONFIG_FILE = '/etc/fan_monitor.conf'
+DATA_FLUSH_INTERVAL = 60  # Cycles between flush+fsync of the data file
+_TEMP_RE = re.compile(r'([-+]?\d+(?:\.\d+)?)')  # First number in a sensor value or smart-log field
+Q_DIRTY_EPS = 1e-4  # Smaller Q-value changes do not count towards the next save
+STATE_BUCKETS = 100  # Buckets per temperature axis of the Q-table; higher temperatures share the last one
 
 def setup_logging(debug: bool):
     """Configures the logging for the application."""
@@ -47,64 +60,107 @@ def notify_root(subject: str, message: str):
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
         logging.error(f"Failed to send email to root: {e}")
 
+@njit(cache=True)
+def q_update(Q, tried, r, n, ra, ca, nr, nn, reward, alpha, gamma):
+    """Applies the Bellman update to Q[r, n, ra, ca] in place and returns (old, new) values.
+
+    The bootstrap takes the best tried action of the next state (0.0 if none was tried),
+    so the zeros of untried actions never stand in for a value.
+    """
+    old = Q[r, n, ra, ca]
+    next_max = -np.inf
+    next_q = Q[nr, nn]
+    next_tried = tried[nr, nn]
+    for i in range(next_q.shape[0]):
+        for j in range(next_q.shape[1]):
+            if next_tried[i, j] and next_q[i, j] > next_max:
+                next_max = next_q[i, j]
+    if next_max == -np.inf:
+        next_max = 0.0
+    new = old + alpha * (reward + gamma * next_max - old)
+    Q[r, n, ra, ca] = new
+    tried[r, n, ra, ca] = True
+    return old, new
+
 class QTableManager:
     """Handles loading and saving the Q-table."""
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, shape: Tuple[int, ...],
+                 action_index: Tuple[Dict[int, int], Dict[int, int]], legacy_path: Optional[str] = None):
         self.file_path = file_path
+        self.shape = shape
+        self.action_index = action_index  # (rad speed -> index, chs speed -> index)
+        self.legacy_path = legacy_path
 
-    @staticmethod
-    def _key_to_str(key: Tuple[int, ...]) -> str:
-        """Converts a tuple key to a string."""
-        return '_'.join(map(str, key))
-
-    @staticmethod
-    def _str_to_key(key_str: str) -> Tuple[int, ...]:
-        """Converts a string key back to a tuple of integers."""
-        return tuple(map(int, key_str.split('_')))
-
-    def save(self, q_table: Dict[Tuple[int, int], Dict[Tuple[int, int], float]]):
-        """Saves the Q-table to a JSON file."""
+    def save(self, q_table: np.ndarray):
+        """Saves the Q-table to a compressed .npz file."""
         try:
-            q_serializable = {
-                self._key_to_str(state): {
-                    self._key_to_str(action): value
-                    for action, value in actions.items()
-                }
-                for state, actions in q_table.items()
-            }
-            with open(self.file_path, 'w') as f:
-                json.dump(q_serializable, f, indent=2)
-            logging.debug(f"Q-table with {len(q_table)} states saved successfully.")
+            tmp_path = self.file_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, Q=q_table)
+            os.replace(tmp_path, self.file_path)
+            logging.debug("Q-table with shape %s saved successfully.", q_table.shape)
         except IOError as e:
             logging.error(f"Failed to write Q-table to {self.file_path}: {e}")
         except Exception as e:
             logging.error(f"An unexpected error occurred while saving the Q-table: {e}")
 
-    def load(self, reset: bool = False) -> Dict[Tuple[int, int], Dict[Tuple[int, int], float]]:
-        """Loads the Q-table from a JSON file."""
-        if reset or not os.path.exists(self.file_path):
-            logging.info("Initializing a new Q-table." if not reset else "Resetting Q-table as requested.")
-            return {}
+    def _empty(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns a zeroed Q-table and an all-False tried mask."""
+        return np.zeros(self.shape, dtype=np.float32), np.zeros(self.shape, dtype=np.bool_)
+
+    def _import_legacy(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Converts the JSON {state: {action: value}} Q-table of older versions into the dense layout."""
+        q_table, tried = self._empty()
+        rad_idx, chs_idx = self.action_index
+        with open(self.legacy_path, 'r') as f:
+            legacy = json.load(f)
+        for state_key, actions in legacy.items():
+            r, n = map(int, state_key.split('_'))
+            for action_key, value in actions.items():
+                rad, chs = map(int, action_key.split('_'))
+                if 0 <= r < self.shape[0] and 0 <= n < self.shape[1] and rad in rad_idx and chs in chs_idx:
+                    q_table[r, n, rad_idx[rad], chs_idx[chs]] = value
+                    tried[r, n, rad_idx[rad], chs_idx[chs]] = True
+        return q_table, tried
+
+    def load(self, reset: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """Loads the Q-table from a .npz file, importing the legacy JSON table if that is all there is.
+
+        Returns (q_table, tried), where tried marks actions taken at least once.
+        """
+        if reset:
+            logging.info("Resetting Q-table as requested.")
+            q_table, tried = self._empty()
+            self.save(q_table)  # Also keeps the legacy table from being imported on a later start
+            return q_table, tried
         try:
-            with open(self.file_path, 'r') as f:
-                q_serializable = json.load(f)
-
-            q_table = {
-                self._str_to_key(state_str): {
-                    self._str_to_key(action_str): value
-                    for action_str, value in actions.items()
-                }
-                for state_str, actions in q_serializable.items()
-            }
-            logging.info(f"Q-table with {len(q_table)} states loaded successfully.")
-            return q_table
-        except (IOError, json.JSONDecodeError) as e:
+            if os.path.exists(self.file_path):
+                with np.load(self.file_path) as data:
+                    q_table = data['Q']
+                if q_table.shape != self.shape:
+                    logging.error(f"Q-table in {self.file_path} has shape {q_table.shape}, expected {self.shape}. Starting with an empty table.")
+                    return self._empty()
+                q_table = q_table.astype(np.float32, copy=False)
+                # A saved table does not store the mask, so nonzero entries stand in for it
+                tried = q_table != 0
+                source = self.file_path
+            elif self.legacy_path and os.path.exists(self.legacy_path):
+                # One-time import: the .npz written here takes over on later starts
+                q_table, tried = self._import_legacy()
+                self.save(q_table)
+                source = self.legacy_path
+            else:
+                logging.info("Initializing a new Q-table.")
+                return self._empty()
+            logging.info(f"Q-table loaded from {source} with {int(np.count_nonzero(tried.any(axis=(2, 3))))} states.")
+            return q_table, tried
+        except (IOError, ValueError, KeyError) as e:
             logging.error(f"Failed to load or parse Q-table from {self.file_path}: {e}. Starting with an empty table.")
-            return {}
+            return self._empty()
         except Exception as e:
             logging.error(f"An unexpected error occurred while loading the Q-table: {e}. Starting with an empty table.")
-            return {}
+            return self._empty()
 
 
 class FanController:
@@ -114,13 +170,46 @@ class FanController:
 
     def __init__(self, config: Dict[str, Any], reset_q_table: bool = False):
         self.config = config
-        self.q_table_manager = QTableManager(Q_TABLE_FILE)
-        self.q_table = self.q_table_manager.load(reset=reset_q_table)
+        self.rad_action_values, self.chs_action_values = self._generate_action_values()
+        self._rad_action_idx = {int(v): i for i, v in enumerate(self.rad_action_values)}
+        self._chs_action_idx = {int(v): i for i, v in enumerate(self.chs_action_values)}
+
+        # Q[rad_bucket, nvme_bucket, rad_action_idx, chs_action_idx]
+        self.q_table_manager = QTableManager(
+            Q_TABLE_FILE, (STATE_BUCKETS, STATE_BUCKETS, len(self.rad_action_values), len(self.chs_action_values)),
+            (self._rad_action_idx, self._chs_action_idx), LEGACY_Q_TABLE_FILE)
+        # _tried marks actions taken at least once
+        self.Q, self._tried = self.q_table_manager.load(reset=reset_q_table)
+        self._visited = self._tried.any(axis=(2, 3))
+        self.q_states = int(np.count_nonzero(self._visited))
         self.epsilon = self.config['q_learning']['epsilon_start']
-        self.possible_actions = self._generate_possible_actions()
-        self.temp_rad_hist: List[float] = []
-        self.temp_nvme_hist: List[float] = []
+        self._alpha = float(self.config['q_learning']['alpha'])
+        self._gamma = float(self.config['q_learning']['gamma'])
+        self._dirty = 0  # Q-table updates since the last save that changed a value by more than Q_DIRTY_EPS
+        self._cached_device: Optional[Any] = None
+        self._hwmon_paths: Optional[List[str]] = None
+        self._last_sent: Tuple[Optional[int], Optional[int]] = (None, None)  # (rad, chs) last written to the device
+        # The sampler thread and the control loop share one HID handle; every liquidctl call holds this lock
+        self._device_lock = threading.Lock()
+        # Latest (temp_rad, temp_nvme, epoch) sample; the sampler replaces a sample the control loop has not taken yet
+        self._samples: queue.Queue = queue.Queue(maxsize=1)
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        # Greedy action indices for the last exploited state, kept in step with Q by update_q_table
+        self._greedy_state: Optional[Tuple[int, int]] = None
+        self._greedy_idx: Tuple[int, int] = (0, 0)
+        self._rng = np.random.default_rng()  # Exploration draws; avoids the legacy global RandomState
+        # Moving-average ring buffers: _hist_idx is the next slot to write, _hist_n the filled length
+        history_len = self.config['state_bucketing']['history_length']
+        self._rad_buf = np.zeros(history_len, dtype=np.float32)
+        self._nvme_buf = np.zeros(history_len, dtype=np.float32)
+        self._hist_idx = 0
+        self._hist_n = 0
         self._initialize_data_file()
+        # Data file stays open for the controller's lifetime; rows are flushed every DATA_FLUSH_INTERVAL cycles
+        self._data_fh = open(DATA_FILE, 'a', newline='', buffering=65536)
+        self._data_writer = csv.writer(self._data_fh)
+        self._data_rows = 0
 
     def _initialize_data_file(self):
         """Creates the data log file with headers if it doesn't exist."""
@@ -136,15 +225,17 @@ class FanController:
             except IOError as e:
                 logging.error(f"Failed to initialize data file {DATA_FILE}: {e}")
 
-    def _generate_possible_actions(self) -> List[Tuple[int, int]]:
-        """Generates all possible fan speed combinations based on config."""
+    def _generate_action_values(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Generates the radiator and chassis fan speed grids based on config."""
         fan_cfg = self.config['fans']
-        rad_speeds = range(fan_cfg['rad_min'], fan_cfg['rad_max'] + 1, fan_cfg['step'])
-        chs_speeds = range(fan_cfg['chs_min'], fan_cfg['chs_max'] + 1, fan_cfg['step'])
-        return [(rad, chs) for rad in rad_speeds for chs in chs_speeds]
+        rad_speeds = np.arange(fan_cfg['rad_min'], fan_cfg['rad_max'] + 1, fan_cfg['step'], dtype=np.int32)
+        chs_speeds = np.arange(fan_cfg['chs_min'], fan_cfg['chs_max'] + 1, fan_cfg['step'], dtype=np.int32)
+        return rad_speeds, chs_speeds
 
     def _get_device(self) -> Optional[Any]:
-        """Finds and returns the target liquidctl device."""
+        """Returns the target liquidctl device, enumerating USB devices only when none is cached."""
+        if self._cached_device is not None:
+            return self._cached_device
         try:
             devices = list(find_liquidctl_devices())
             if not devices:
@@ -154,7 +245,10 @@ class FanController:
             device_name = self.config['liquidctl']['device_name']
             for dev in devices:
                 if device_name in dev.description:
-                    logging.debug(f"Found target device: {dev.description}")
+                    logging.debug("Found target device: %s", dev.description)
+                    # Connected once here; the handle stays open until _release_device()
+                    dev.connect()
+                    self._cached_device = dev
                     return dev
             
             logging.error(f"Target device '{device_name}' not found.")
@@ -163,24 +257,51 @@ class FanController:
             logging.error(f"Error finding liquidctl devices: {e}")
             return None
 
-    def get_temperatures(self, device: Any) -> Tuple[Optional[float], Optional[float]]:
+    def _release_device(self):
+        """Disconnects the cached device so the next cycle re-enumerates and reconnects."""
+        if self._cached_device is None:
+            return
+        try:
+            self._cached_device.disconnect()
+        except Exception:
+            pass  # The handle is usually already broken when this runs
+        self._cached_device = None
+        self._last_sent = (None, None)
+
+    def get_temperatures(self) -> Tuple[Optional[float], Optional[float]]:
         """Reads temperatures from the radiator and NVMe drives."""
-        # Radiator temperature
+        with self._device_lock:
+            device = self._get_device()
+            if not device:
+                return None, None
+            temp_rad = self._read_radiator_temp(device)
+        # NVMe reads do not touch the HID handle, so the lock is already released
+        return temp_rad, self._read_nvme_temp()
+
+    def _read_radiator_temp(self, device: Any) -> Optional[float]:
+        """Reads the configured radiator sensor from one get_status() call. Caller holds _device_lock."""
         temp_rad = None
         try:
-            with device.connect():
-                status = device.get_status()
-                for key, value, _ in status:
-                    if self.config['liquidctl']['temp_sensor_key'] in key:
-                        temp_rad = float(str(value).replace("°C", "").strip())
-                        break
+            status = device.get_status()
+            for key, value, _ in status:
+                if self.config['liquidctl']['temp_sensor_key'] in key:
+                    m = _TEMP_RE.search(str(value))
+                    if m:
+                        temp_rad = float(m.group(1))
+                    break
             if temp_rad is None:
                  logging.warning("Could not read radiator temperature sensor.")
         except Exception as e:
             logging.error(f"Error reading radiator temperature: {e}")
+            self._release_device()  # Reconnect on the next cycle
+        return temp_rad
+
+    def _read_nvme_temp(self) -> Optional[float]:
+        """Reads the maximum NVMe temperature, preferring sysfs hwmon over 'nvme smart-log'."""
+        temp_nvme = self._read_nvme_hwmon()
+        if temp_nvme is not None:
+            return temp_nvme
 
-        # NVMe temperature
-        temp_nvme = None
         try:
             nvme_devices = glob.glob('/dev/nvme*n1')
             nvme_temps = []
@@ -191,11 +312,11 @@ class FanController:
                 )
                 for line in result.stdout.splitlines():
                     if "temperature" in line.lower() and "sensor" not in line.lower():
-                        # FIX: Make parsing more robust to handle formats like "27°C"
-                        parts = line.split(":")
-                        if len(parts) > 1:
-                            temp_str = parts[1].replace("°C", "").strip()
-                            nvme_temps.append(float(temp_str))
+                        # Handles formats like "27°C" and "27 °C (300 Kelvin)"
+                        _, sep, field = line.partition(":")
+                        m = _TEMP_RE.search(field) if sep else None
+                        if m:
+                            nvme_temps.append(float(m.group(1)))
             if nvme_temps:
                 temp_nvme = max(nvme_temps)
             else:
@@ -203,23 +324,48 @@ class FanController:
         except (subprocess.CalledProcessError, FileNotFoundError, IndexError, ValueError) as e:
             logging.error(f"Error reading NVMe temperature: {e}")
 
-        return temp_rad, temp_nvme
+        return temp_nvme
+
+    def _read_nvme_hwmon(self) -> Optional[float]:
+        """Reads the maximum NVMe composite temperature from sysfs hwmon, or None if unavailable."""
+        if not self._hwmon_paths:
+            self._hwmon_paths = glob.glob('/sys/class/nvme/nvme*/hwmon*/temp1_input')
+            if not self._hwmon_paths:
+                return None
+        try:
+            temps = []
+            for path in self._hwmon_paths:
+                with open(path) as f:
+                    temps.append(int(f.read().strip()) / 1000.0)  # millidegrees C
+            return max(temps)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to read NVMe hwmon temperature: {e}")
+            self._hwmon_paths = None  # Re-glob on the next cycle
+            return None
 
     def _bucket_temp(self, temp: float) -> int:
-        """Converts a temperature into a discrete state bucket."""
-        return int(temp // self.config['state_bucketing']['step'])
+        """Converts a temperature into a discrete state bucket, clamped to the Q-table range."""
+        return min(max(int(temp // self.config['state_bucketing']['step']), 0), STATE_BUCKETS - 1)
 
     def choose_action(self, state: Tuple[int, int]) -> Tuple[int, int]:
         """Chooses an action using an epsilon-greedy policy."""
-        if state not in self.q_table or np.random.random() < self.epsilon:
+        if not self._visited[state] or self._rng.random() < self.epsilon:
             # Exploration
-            action = self.possible_actions[np.random.randint(len(self.possible_actions))]
-            logging.debug(f"Exploring: chose random action {action}")
+            ra = self._rng.integers(len(self.rad_action_values))
+            ca = self._rng.integers(len(self.chs_action_values))
+            action = (int(self.rad_action_values[ra]), int(self.chs_action_values[ca]))
+            logging.debug("Exploring: chose random action %s", action)
             return action
         else:
-            # Exploitation
-            best_action = max(self.q_table[state], key=self.q_table[state].get)
-            logging.debug(f"Exploiting: chose best action {best_action} for state {state}")
+            # Exploitation; the argmax is only recomputed when the state changed
+            if state != self._greedy_state:
+                # Untried actions are never preferred, whatever their stored 0.0 compares to
+                q_row = np.where(self._tried[state], self.Q[state], -np.inf)
+                self._greedy_idx = np.unravel_index(np.argmax(q_row), q_row.shape)
+                self._greedy_state = state
+            ra, ca = self._greedy_idx
+            best_action = (int(self.rad_action_values[ra]), int(self.chs_action_values[ca]))
+            logging.debug("Exploiting: chose best action %s for state %s", best_action, state)
             return best_action
 
     def calculate_reward(self, temp_rad: float, temp_nvme: float, fan_rad: int, fan_chs: int) -> float:
@@ -270,78 +416,145 @@ class FanController:
 
     def update_q_table(self, state: Tuple, action: Tuple, reward: float, next_state: Tuple):
         """Updates the Q-table based on the Bellman equation."""
-        q_cfg = self.config['q_learning']
-        old_value = self.q_table.get(state, {}).get(action, 0.0)
-
-        next_max = 0.0
-        if next_state in self.q_table and self.q_table[next_state]:
-            next_max = max(self.q_table[next_state].values())
-
-        new_value = old_value + q_cfg['alpha'] * (reward + q_cfg['gamma'] * next_max - old_value)
-        
-        if state not in self.q_table:
-            self.q_table[state] = {}
-        self.q_table[state][action] = new_value
+        ra = self._rad_action_idx.get(action[0])
+        ca = self._chs_action_idx.get(action[1])
+        if ra is None or ca is None:
+            logging.debug("Action %s is outside the configured fan grid; Q-table not updated.", action)
+            return
+
+        old_value, new_value = q_update(self.Q, self._tried, state[0], state[1], ra, ca, next_state[0], next_state[1],
+                                        float(reward), self._alpha, self._gamma)
+        if abs(new_value - old_value) > Q_DIRTY_EPS:
+            self._dirty += 1
+
+        # Keep the cached greedy action valid: a raised value may become the best,
+        # a lowered best forces a fresh argmax on the next exploitation
+        if state == self._greedy_state:
+            if (ra, ca) == tuple(self._greedy_idx):
+                if new_value < old_value:
+                    self._greedy_state = None
+            elif new_value > self.Q[state + tuple(self._greedy_idx)]:
+                self._greedy_idx = (ra, ca)
+
+        if not self._visited[state]:
+            self._visited[state] = True
+            self.q_states += 1
 
     def set_fan_speeds(self, device: Any, rad_speed: int, chs_speed: int):
         """Applies the chosen fan speeds to the hardware."""
+        if (rad_speed, chs_speed) == self._last_sent:
+            return  # Unchanged: nothing to send
+
+        # Only the fan group whose speed changed is written; each set_fixed_speed is a USB transfer
+        last_rad, last_chs = self._last_sent
         try:
-            with device.connect():
+            if rad_speed != last_rad:
                 for i in self.config['liquidctl']['rad_fan_ids']:
                     device.set_fixed_speed(f"fan{i}", rad_speed)
+                self._last_sent = (rad_speed, last_chs)
+            if chs_speed != last_chs:
                 for i in self.config['liquidctl']['chs_fan_ids']:
                     device.set_fixed_speed(f"fan{i}", chs_speed)
-            logging.debug(f"Set fan speeds: Radiator={rad_speed}%, Chassis={chs_speed}%")
+                self._last_sent = (rad_speed, chs_speed)
+            logging.info(f"Set fan speeds: Radiator={rad_speed}%, Chassis={chs_speed}%")
         except Exception as e:
             logging.error(f"Failed to set fan speeds: {e}")
+            self._release_device()  # Reconnect on the next cycle
 
-    def log_data(self, rad_avg: float, nvme_avg: float, rad_speed: int, chs_speed: int, reward: float):
-        """Logs the current cycle's data to a CSV file."""
+    def log_data(self, ts: str, rad_avg: float, nvme_avg: float, rad_speed: int, chs_speed: int, reward: float):
+        """Logs the current cycle's data to the CSV file."""
         try:
-            with open(DATA_FILE, 'a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    datetime.now().isoformat(),
-                    f"{rad_avg:.2f}",
-                    f"{nvme_avg:.2f}",
-                    rad_speed,
-                    chs_speed,
-                    f"{reward:.2f}",
-                    f"{self.epsilon:.4f}",
-                    len(self.q_table)
-                ])
+            self._data_writer.writerow([
+                ts,
+                f"{rad_avg:.2f}",
+                f"{nvme_avg:.2f}",
+                rad_speed,
+                chs_speed,
+                f"{reward:.2f}",
+                f"{self.epsilon:.4f}",
+                self.q_states
+            ])
+            self._data_rows += 1
+            if self._data_rows % DATA_FLUSH_INTERVAL == 0:
+                self._data_fh.flush()
+                os.fsync(self._data_fh.fileno())
         except IOError as e:
             logging.error(f"Failed to write to data file {DATA_FILE}: {e}")
 
+    def close_data_file(self):
+        """Flushes and closes the data file."""
+        try:
+            self._data_fh.close()
+        except IOError as e:
+            logging.error(f"Failed to close data file {DATA_FILE}: {e}")
+
     def run(self):
         """The main control loop for the fan controller."""
         notify_root("Fan Monitor Started", "Q-learning fan monitor is now active.")
         logging.info(f"Starting fan controller with targets: RAD={self.config['targets']['temp_rad']}°C, NVMe={self.config['targets']['nvme']}°C")
 
-        save_counter = 0
-        while True:
-            device = self._get_device()
-            if not device:
-                time.sleep(self.config['main_loop']['interval_seconds'])
-                continue
-                
-            temp_rad, temp_nvme = self.get_temperatures(device)
+        self._sampler = threading.Thread(target=self._sample_loop, name='fan-sampler', daemon=True)
+        self._sampler.start()
+        try:
+            self._control_loop()
+        finally:
+            self._stop.set()
+            self._sampler.join(timeout=self.config['main_loop']['interval_seconds'])
+            with self._device_lock:
+                self._release_device()
+            self.close_data_file()
+
+    def _publish(self, item: Any):
+        """Puts item on the one-slot sample queue, replacing anything the control loop has not taken yet."""
+        try:
+            self._samples.get_nowait()
+        except queue.Empty:
+            pass
+        self._samples.put_nowait(item)
+
+    def _sample_loop(self):
+        """Sampler thread: reads temperatures once per interval and publishes the latest sample."""
+        interval = self.config['main_loop']['interval_seconds']
+        try:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                temp_rad, temp_nvme = self.get_temperatures()
+
+                if temp_rad is None or temp_nvme is None:
+                    logging.warning("Incomplete temperature data. Skipping cycle.")
+                else:
+                    self._publish((temp_rad, temp_nvme, time.time()))
+
+                # Sampling keeps the configured rate; the read time is taken out of the wait
+                self._stop.wait(max(0.0, interval - (time.monotonic() - started)))
+        except Exception as e:
+            # Handed to the control loop, which re-raises it so run() fails instead of idling
+            logging.error(f"Temperature sampler failed: {e}")
+            self._publish(e)
 
-            if temp_rad is None or temp_nvme is None:
-                logging.warning("Incomplete temperature data. Skipping cycle.")
-                time.sleep(self.config['main_loop']['interval_seconds'])
-                continue
+    def _control_loop(self):
+        """Runs control cycles on samples from the sampler thread until interrupted."""
+        interval = self.config['main_loop']['interval_seconds']
+        while True:
+            try:
+                sample = self._samples.get(timeout=interval)
+            except queue.Empty:
+                if not self._sampler.is_alive():
+                    raise RuntimeError("Temperature sampler thread exited unexpectedly")
+                continue  # No device or incomplete reads; the sampler has already logged why
+            if isinstance(sample, Exception):
+                raise RuntimeError(f"Temperature sampler failed: {sample}") from sample
+            temp_rad, temp_nvme, sampled_at = sample
 
             # Update history and calculate moving average
-            history_len = self.config['state_bucketing']['history_length']
-            self.temp_rad_hist.append(temp_rad)
-            self.temp_nvme_hist.append(temp_nvme)
-            if len(self.temp_rad_hist) > history_len:
-                self.temp_rad_hist.pop(0)
-                self.temp_nvme_hist.pop(0)
-            
-            rad_avg = np.mean(self.temp_rad_hist)
-            nvme_avg = np.mean(self.temp_nvme_hist)
+            history_len = len(self._rad_buf)
+            self._rad_buf[self._hist_idx] = temp_rad
+            self._nvme_buf[self._hist_idx] = temp_nvme
+            self._hist_idx = (self._hist_idx + 1) % history_len
+            self._hist_n = min(self._hist_n + 1, history_len)
+
+            rad_avg = float(self._rad_buf[:self._hist_n].mean())
+            nvme_avg = float(self._nvme_buf[:self._hist_n].mean())
 
             # Define state and choose action
             current_state = (self._bucket_temp(rad_avg), self._bucket_temp(nvme_avg))
@@ -356,7 +569,10 @@ class FanController:
                 action = self.choose_action(current_state)
 
             rad_speed, chs_speed = action
-            self.set_fan_speeds(device, rad_speed, chs_speed)
+            with self._device_lock:
+                device = self._get_device()
+                if device:
+                    self.set_fan_speeds(device, rad_speed, chs_speed)
 
             # Calculate reward and update Q-table
             reward = self.calculate_reward(rad_avg, nvme_avg, rad_speed, chs_speed)
@@ -370,17 +586,16 @@ class FanController:
             log_msg = (
                 f"State: {current_state}, Temps: RAD={rad_avg:.1f}°C, NVMe={nvme_avg:.1f}°C | "
                 f"Action: R/C={rad_speed}/{chs_speed} | Reward: {reward:.2f} | "
-                f"Epsilon: {self.epsilon:.3f} | Q-States: {len(self.q_table)}"
+                f"Epsilon: {self.epsilon:.3f} | Q-States: {self.q_states}"
             )
             logging.info(log_msg)
-            self.log_data(rad_avg, nvme_avg, rad_speed, chs_speed, reward)
-
-            save_counter += 1
-            if save_counter >= self.config['main_loop']['save_q_table_interval_cycles']:
-                self.q_table_manager.save(self.q_table)
-                save_counter = 0
+            ts = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(sampled_at))
+            self.log_data(ts, rad_avg, nvme_avg, rad_speed, chs_speed, reward)
 
-            time.sleep(self.config['main_loop']['interval_seconds'])
+            # Saved after enough meaningful updates rather than every N cycles
+            if self._dirty >= self.config['main_loop']['save_q_table_interval_cycles']:
+                self.q_table_manager.save(self.Q)
+                self._dirty = 0
 
 def main():
     """Main function to parse arguments and run the controller."""
@@ -404,12 +619,12 @@ def main():
     except KeyboardInterrupt:
         logging.info("Service interrupted by user. Shutting down.")
         if 'controller' in locals():
-            controller.q_table_manager.save(controller.q_table)
+            controller.q_table_manager.save(controller.Q)
             notify_root("Fan Monitor Stopped", "Fan monitor script was stopped manually.")
     except Exception as e:
         logging.critical("An unhandled exception occurred.", exc_info=True)
         if 'controller' in locals():
-            controller.q_table_manager.save(controller.q_table)
+            controller.q_table_manager.save(controller.Q)
         notify_root("Fan Monitor Crashed", f"The fan monitor script crashed due to an error: {e}")
 
 if __name__ == "__main__":